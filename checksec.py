@@ -4,22 +4,31 @@ from __future__ import print_function
 
 import sys
 import re
+import argparse
+import json
+import multiprocessing
+import mmap
+import struct
+from functools import partial
+from operator import methodcaller
 from six.moves import cStringIO
 import six
 
 try:
     from elftools.common.exceptions import ELFError
-    from elftools.elf.elffile import ELFFile
-    from elftools.elf.sections import SymbolTableSection
     from elftools.common.py3compat import bytes2str
-    from elftools.elf.constants import P_FLAGS
-    from elftools.elf.dynamic import DynamicSection
+    from elfheader import ElfHeader, ElfLimit, ET_DYN, PF_X, \
+        PT_GNU_RELRO, PT_GNU_STACK, SHT_NOBITS
 except ImportError as exc:
     print(str(exc), file=sys.stderr)
     print("""\n[-] Please install python-pyelftools package""",
           file=sys.stderr)
     sys.exit(-1)
 
+# bump whenever a check changes its verdicts, this invalidates all the
+# results stored by resultcache
+CHECKER_VERSION = 2
+
 # http://people.redhat.com/sgrubb/security/find-elf4tmp
 TMP_FUNCTIONS = set(["^mkstemp",  "^tempnam", "^tmpfile"])
 
@@ -65,56 +74,225 @@ UNSAFE_FUNCTIONS = set([
 
 STACK_CHK = set(["__stack_chk_fail", "__stack_smash_handler"])
 
+# DT_FLAGS and DT_FLAGS_1 bits
+DF_BIND_NOW = 0x8
+DF_1_NOW = 0x1
+DF_1_PIE = 0x8000000
+
+# sections which can hold string constants
+STRING_SECTIONS = set([".rodata", ".data"])
+
+# printable characters as understood by strings(1)
+PRINTABLE = re.compile(b"[\t\x20-\x7e]")
+TMP_STRING = re.compile(b"/tmp/[\t\x20-\x7e]+")
+
+
+def _tmp_strings(buf, start, end):
+    """
+    Scan buf[start:end] for printable runs (as strings(1) sees them) which
+    begin with /tmp/, skipping mkstemp() style templates.
+
+    """
+    ret = []
+    for match in TMP_STRING.finditer(buf, start, end):
+        begin = match.start()
+        # the run must start right at /tmp/, not somewhere before it
+        if begin > start and PRINTABLE.match(buf, begin - 1, begin):
+            continue
+        line = match.group(0)
+        if b"XXX" not in line:
+            ret.append(bytes2str(line))
+    return ret
+
+
+class BufferStream(object):
+    """
+    Read-only file-like object over a buffer (bytes, memoryview of shared
+    memory, ...). Elf() uses the buffer itself, only the parts pyelftools
+    reads get copied.
+
+    """
+
+    def __init__(self, buf):
+        self.buffer = buf
+        self.size = len(buf)
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else self.pos + size
+        data = bytes(self.buffer[self.pos:end])
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+def _file_buffer(stream):
+    """
+    Return a buffer covering the whole stream, without copying it when
+    the stream is (or can be) memory-mapped or is an in-memory file.
+
+    """
+    if isinstance(stream, mmap.mmap):
+        return stream
+
+    if isinstance(stream, BufferStream):
+        return stream.buffer
+
+    try:
+        return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+
+    if hasattr(stream, "getvalue"):
+        # doesn't copy for io.BytesIO objects created from bytes
+        return stream.getvalue()
+
+    epos = stream.tell()
+    stream.seek(0, 0)
+    data = stream.read()
+    stream.seek(epos, 0)
+    return data
+
+
+def _compile_patterns(patterns, suffix=""):
+    """
+    Split a pattern table into an exact-name set and one combined matcher.
+
+    Patterns of the form "^name$" (after appending suffix) are plain
+    names and go into a hash set, everything else is OR-ed together into
+    a single precompiled regular expression which is used with match().
+
+    """
+    exact = set()
+    rest = []
+    for pattern in sorted(patterns):
+        pattern = pattern + suffix
+        if not pattern.startswith("^"):
+            pattern = "^" + pattern
+        name = pattern[1:-1] if pattern.endswith("$") else None
+        if name is not None and re.match(r"^\w+$", name):
+            exact.add(name)
+        else:
+            rest.append("(?:%s)" % pattern[1:])
+    matcher = re.compile("|".join(rest)).match if rest else None
+    return exact, matcher
+
+
+class SymbolTable(object):
+    """
+    Verdicts collected from a single pass over all symbol tables.
+
+    Every symbol name is decoded once and classified against all the
+    check tables (UNSAFE_FUNCTIONS, IP_PATTERNS, LOCAL_PATTERNS,
+    TMP_FUNCTIONS and STACK_CHK) at the same time.
+
+    """
+    UNSAFE = _compile_patterns(UNSAFE_FUNCTIONS, "$")
+    IP = _compile_patterns(IP_PATTERNS)
+    LOCAL = _compile_patterns(LOCAL_PATTERNS)
+    TMP = _compile_patterns(TMP_FUNCTIONS)
+
+    def __init__(self):
+        self.unsafe = []
+        self.ip = False
+        self.local = False
+        self.tmp = False
+        self.canary = False
+
+    @staticmethod
+    def _matches(table, name):
+        exact, matcher = table
+        return name in exact or (matcher is not None and
+                                 matcher(name) is not None)
+
+    def add(self, name):
+        if not name:
+            return
+        if self._matches(self.UNSAFE, name):
+            self.unsafe.append(name)
+        if name in STACK_CHK:
+            self.canary = True
+        if not self.ip and self._matches(self.IP, name):
+            self.ip = True
+        if not self.local and self._matches(self.LOCAL, name):
+            self.local = True
+        if not self.tmp and self._matches(self.TMP, name):
+            self.tmp = True
+
 
 class Elf(object):
     def __init__(self, fileobj):
-        self.elffile = ELFFile(fileobj)
+        self.stream = fileobj
+        self.header = ElfHeader(_file_buffer(fileobj))
         self.output = sys.stdout
+        self._symbols = None
+        self._symbols_error = None
 
     # our code starts here :-)
 
-    def network(self):
-        ret = "None"
-        for section in self.elffile.iter_sections():
-            if not isinstance(section, SymbolTableSection):
-                continue
-            if section['sh_entsize'] == 0:
-                print(
-                    "\nSymbol table '%s' has a sh_entsize "
-                    "of zero!" % (bytes2str(section.name)), file=sys.stderr)
-                continue
-            for _, symbol in enumerate(section.iter_symbols()):
-                # first match IP_PATTERNS
-                for pattern in IP_PATTERNS:
-                    if re.match(pattern, bytes2str(symbol.name)):
-                        return "network-ip"
-                # then match LOCAL_PATTERNS
-                for pattern in LOCAL_PATTERNS:
-                    if re.match(pattern, bytes2str(symbol.name)):
-                        ret = "network-local"
-                        break
-        return ret
+    def symbols(self):
+        """
+        Walk every symbol table once and cache the verdicts. Raises
+        ElfLimit (every time) if the symbol tables are truncated or too
+        large.
 
-    def _strings(self):
-        stream = self.elffile.stream
-        epos = stream.tell()
-        stream.seek(0, 0)
-        data = stream.read()
-        stream.seek(epos, 0)
+        """
+        if self._symbols is not None:
+            return self._symbols
+        if self._symbols_error is not None:
+            raise self._symbols_error
 
-        ret = []
+        table = SymbolTable()
+        try:
+            for section in self.header.symbol_tables():
+                if section.sh_entsize == 0:
+                    print(
+                        "\nSymbol table '%s' has a sh_entsize "
+                        "of zero!" % section.name, file=sys.stderr)
+                    continue
+                for name in self.header.symbol_names(section):
+                    table.add(name)
+        except ElfLimit as exc:
+            self._symbols_error = exc
+            raise
+        self._symbols = table
+        return table
 
-        # XXX avoid calling eu-strings
-        import subprocess
-        p = subprocess.Popen(
-            "eu-strings", shell=True, stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        out = p.communicate(input=data)[0]
+    def network(self):
+        table = self.symbols()
+        if table.ip:
+            return "network-ip"
+        if table.local:
+            return "network-local"
+        return "None"
 
-        for line in out.splitlines():
-            if re.match(b"^/tmp/.+", line) and "XXX" not in line:
-                ret.append(line)
+    def _strings(self):
+        """
+        Return the printable strings starting with /tmp/ found in the
+        sections which can hold string constants.
 
+        """
+        ret = []
+        buf = self.header.buf
+        for section in self.header.sections():
+            if section.name not in STRING_SECTIONS:
+                continue
+            if section.sh_type == SHT_NOBITS:
+                continue
+            start = section.sh_offset
+            self.header.within(start, section.sh_size)
+            self.header.touch(section.sh_size)
+            ret.extend(_tmp_strings(buf, start, start + section.sh_size))
         return ret
 
     def tempstuff(self):
@@ -124,19 +302,8 @@ class Elf(object):
         if len(tmp_strings) == 0:
             return "None"
 
-        for section in self.elffile.iter_sections():
-            if not isinstance(section, SymbolTableSection):
-                continue
-            if section['sh_entsize'] == 0:
-                print(
-                    "\nSymbol table '%s' has a sh_entsize "
-                    "of zero!" % (bytes2str(section.name)), file=sys.stderr)
-                continue
-            for _, symbol in enumerate(section.iter_symbols()):
-                for pattern in TMP_FUNCTIONS:
-                    if re.match(pattern, bytes2str(symbol.name)):
-
-                        return "None"
+        if self.symbols().tmp:
+            return "None"
 
         return "$".join(tmp_strings)
 
@@ -167,20 +334,7 @@ class Elf(object):
         * "addr2line" like feature for unprotected unsafe functions
 
         """
-        unsafe_list = []
-
-        for section in self.elffile.iter_sections():
-            if not isinstance(section, SymbolTableSection):
-                continue
-            if section['sh_entsize'] == 0:
-                print(
-                    "\nSymbol table '%s' has a sh_entsize "
-                    "of zero!" % (bytes2str(section.name)), file=sys.stderr)
-                continue
-            for _, symbol in enumerate(section.iter_symbols()):
-                for pattern in UNSAFE_FUNCTIONS:
-                    if re.match(pattern + "$", bytes2str(symbol.name)):
-                        unsafe_list.append(bytes2str(symbol.name))
+        unsafe_list = self.symbols().unsafe
 
         if len(unsafe_list) == 0:
             return "Enabled"
@@ -189,58 +343,65 @@ class Elf(object):
 
 
     def canary(self):
-        for section in self.elffile.iter_sections():
-            if not isinstance(section, SymbolTableSection):
-                continue
-            if section['sh_entsize'] == 0:
-                print(
-                    "\nSymbol table '%s' has a sh_entsize "
-                    "of zero!" % (bytes2str(section.name)), file=sys.stderr)
-                continue
-            for _, symbol in enumerate(section.iter_symbols()):
-                if bytes2str(symbol.name) in STACK_CHK:
-                    return "Enabled"
+        if self.symbols().canary:
+            return "Enabled"
         return "Disabled"
 
+    def dynamic(self):
+        """
+        The dynamic section decoded once into a {d_tag: [values]} index.
+
+        String valued tags (DT_NEEDED, DT_RPATH, ...) are stored decoded,
+        everything else as the raw d_val.
+
+        """
+        return self.header.dynamic()
+
     def dynamic_tags(self, key="DT_RPATH"):
-        for section in self.elffile.iter_sections():
-            if not isinstance(section, DynamicSection):
-                continue
-            for tag in section.iter_tags():
-                if tag.entry.d_tag == key:
-                    return "Enabled"
+        if key in self.dynamic():
+            return "Enabled"
         return "Disabled"
 
+    def _dynamic_flag(self, key, flag):
+        for value in self.dynamic().get(key, ()):
+            if value & flag:
+                return True
+        return False
+
+    def bind_now(self):
+        """
+        Immediate binding can be requested by DT_BIND_NOW, DF_BIND_NOW in
+        DT_FLAGS or DF_1_NOW in DT_FLAGS_1.
+
+        """
+        return "DT_BIND_NOW" in self.dynamic() or \
+            self._dynamic_flag("DT_FLAGS", DF_BIND_NOW) or \
+            self._dynamic_flag("DT_FLAGS_1", DF_1_NOW)
+
     def program_headers(self):
-        pflags = P_FLAGS()
-        if self.elffile.num_segments() == 0:
+        if self.header.num_segments() == 0:
             # print('There are no program headers in this file.', \
             #      file=sys.stderr)
             return
 
         found = False
-        for segment in self.elffile.iter_segments():
-            if re.search("GNU_STACK", str(segment['p_type'])):
-                found = True
-                if segment['p_flags'] & pflags.PF_X:
-                    return "Disabled"
+        for segment in self.header.segments_of(PT_GNU_STACK):
+            found = True
+            if segment.p_flags & PF_X:
+                return "Disabled"
         if found:
             return "Enabled"
 
         return "Disabled"
 
     def relro(self):
-        if self.elffile.num_segments() == 0:
+        if self.header.num_segments() == 0:
             # print('There are no program headers in this file.', \
             #      file=sys.stderr)
             return
 
-        have_relro = False
-        for segment in self.elffile.iter_segments():
-            if re.search("GNU_RELRO", str(segment['p_type'])):
-                have_relro = True
-                break
-        if self.dynamic_tags("DT_BIND_NOW") == "Enabled" and have_relro:
+        have_relro = bool(self.header.segments_of(PT_GNU_RELRO))
+        if have_relro and self.bind_now():
             return "Enabled"
         if have_relro:
             return "Partial"
@@ -248,52 +409,299 @@ class Elf(object):
         return "Disabled"
 
     def pie(self):
-        header = self.elffile.header
-        if self.dynamic_tags("EXEC") == "Enabled":
-            return "Disabled"
-        if "ET_DYN" in header['e_type']:
-            if self.dynamic_tags("DT_DEBUG") == "Enabled":
+        if self.header.e_type == ET_DYN:
+            if "DT_DEBUG" in self.dynamic() or \
+                    self._dynamic_flag("DT_FLAGS_1", DF_1_PIE):
                 return "Enabled"
             else:
                 return "DSO"
         return "Disabled"
 
     def getdeps(self):
-        deps = []
+        return list(self.dynamic().get("DT_NEEDED", ()))
 
-        if self.elffile.num_segments() == 0:
-            return deps
 
-        for segment in self.elffile.iter_segments():
-            if re.search("PT_DYNAMIC", str(segment['p_type'])):
-                # this file uses dynamic linking, so read the dynamic section
-                # and find DT_SONAME tag
-                for section in self.elffile.iter_sections():
-                    if not isinstance(section, DynamicSection):
-                        continue
-                    for tag in section.iter_tags():
-                        if tag.entry.d_tag == 'DT_NEEDED':
-                            deps.append(bytes2str(tag.needed))
-                break
+class CheckResult(object):
+    """
+    Verdicts of process_file() in output order. Checks which were not run
+    are left unset and don't show up in any of the serialized forms.
 
-        return deps
+    """
+    __slots__ = FIELDS = ("NX", "CANARY", "RELRO", "PIE", "RPATH",
+                          "RUNPATH", "FORTIFY", "CATEGORY", "TEMPPATHS",
+                          "DEPS")
 
+    _MASK = struct.Struct("<H")
 
-def process_file(elfo, deps=True):
+    def items(self):
+        for name in self.FIELDS:
+            try:
+                yield name, getattr(self, name)
+            except AttributeError:
+                continue
 
-    output = "NX=%s,CANARY=%s,RELRO=%s,PIE=%s,RPATH=%s,RUNPATH=%s," \
-        "FORTIFY=%s,CATEGORY=%s,TEMPPATHS=%s" \
-        % (elfo.program_headers(), elfo.canary(), elfo.relro(), elfo.pie(),
-            elfo.dynamic_tags("DT_RPATH"), elfo.dynamic_tags("DT_RUNPATH"),
-            elfo.fortify(), elfo.network(), elfo.tempstuff())
-    if deps:
-        output = output + (",DEPS=%s" % '$'.join(elfo.getdeps()))
+    def as_dict(self):
+        """JSON friendly form, every value is a string like in the CSV."""
+        return dict((name, "%s" % value) for name, value in self.items())
 
-    return output
+    def as_csv(self):
+        return ",".join("%s=%s" % item for item in self.items())
 
-if __name__ == "__main__":
+    __str__ = as_csv
+
+    def to_bytes(self):
+        """
+        Compact binary form, a bitmask of the set fields followed by their
+        NUL separated values.
 
-    if len(sys.argv) < 2:
+        """
+        mask = 0
+        values = []
+        for i, name in enumerate(self.FIELDS):
+            try:
+                value = getattr(self, name)
+            except AttributeError:
+                continue
+            mask |= 1 << i
+            value = "%s" % value
+            if not isinstance(value, bytes):
+                value = value.encode("utf-8")
+            values.append(value)
+        return self._MASK.pack(mask) + b"\0".join(values)
+
+    @classmethod
+    def from_bytes(cls, data):
+        result = cls()
+        (mask,) = cls._MASK.unpack_from(data, 0)
+        values = bytes(data[cls._MASK.size:]).split(b"\0")
+        values.reverse()
+        for i, name in enumerate(cls.FIELDS):
+            if mask & (1 << i):
+                value = values.pop()
+                if six.PY3:
+                    value = value.decode("utf-8")
+                setattr(result, name, value)
+        return result
+
+    def __getstate__(self):
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        for name, value in self.from_bytes(state).items():
+            setattr(self, name, value)
+
+
+def _deps(elfo):
+    return '$'.join(elfo.getdeps())
+
+
+# check name => Elf method computing its verdict, in output order; every
+# check only pulls in the prerequisites (symbol pass, dynamic index,
+# /tmp/ strings) it needs
+CHECKS = (
+    ("NX", methodcaller("program_headers")),
+    ("CANARY", methodcaller("canary")),
+    ("RELRO", methodcaller("relro")),
+    ("PIE", methodcaller("pie")),
+    ("RPATH", methodcaller("dynamic_tags", "DT_RPATH")),
+    ("RUNPATH", methodcaller("dynamic_tags", "DT_RUNPATH")),
+    ("FORTIFY", methodcaller("fortify")),
+    ("CATEGORY", methodcaller("network")),
+    ("TEMPPATHS", methodcaller("tempstuff")),
+    ("DEPS", _deps))
+
+CHECK_NAMES = tuple(name for name, _ in CHECKS)
+
+
+def parse_checks(spec):
+    """
+    Turn a comma separated list like "PIE,RELRO" into a tuple of check
+    names, "all" selects everything and an empty string nothing.
+
+    """
+    if spec.strip().lower() == "all":
+        return CHECK_NAMES
+    checks = []
+    for name in spec.split(","):
+        name = name.strip().upper()
+        if not name:
+            continue
+        if name not in CHECK_NAMES:
+            raise ValueError("unknown check '%s', choose from %s" %
+                             (name, ",".join(CHECK_NAMES)))
+        checks.append(name)
+    return tuple(checks)
+
+
+def checks_argument(spec):
+    """argparse type for --checks options"""
+    try:
+        return parse_checks(spec)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def process_file(elfo, deps=True, checks=None):
+    """
+    Run the selected checks (all of them by default, DEPS only when deps
+    is set) on elfo and return a CheckResult. Checks which aren't
+    selected are skipped entirely and left unset in the result.
+
+    Checks which run into a truncated table or a parsing limit (see
+    elfheader) get an "Unchecked$<reason>" verdict.
+
+    """
+    checks = _selected(deps, checks)
+
+    result = CheckResult()
+    for name, check in CHECKS:
+        if name in checks:
+            try:
+                verdict = check(elfo)
+            except ElfLimit as exc:
+                verdict = "Unchecked$%s" % exc
+            setattr(result, name, verdict)
+
+    return result
+
+
+def check_image(stream, deps=True, checks=None):
+    """
+    process_file() on Elf(stream). A file whose ELF header already runs
+    into a parsing limit (a truncated header, ...) gets an
+    "Unchecked$<reason>" verdict for every selected check, anything which
+    isn't ELF at all raises ELFError.
+
+    """
+    try:
+        elfo = Elf(stream)
+    except ElfLimit as exc:
+        result = CheckResult()
+        for name in _selected(deps, checks):
+            setattr(result, name, "Unchecked$%s" % exc)
+        return result
+    return process_file(elfo, deps, checks)
+
+
+def _selected(deps, checks):
+    """Names of the checks process_file() runs"""
+    if checks is None:
+        checks = CHECK_NAMES if deps else CHECK_NAMES[:-1]
+    return set(checks)
+
+
+def check_path(filename, checks=None, cache=None):
+    """
+    Memory-map filename and run process_file() on it, through cache (a
+    resultcache.ResultCache) when one is given.
+
+    Returns a (filename, CheckResult, None) tuple, or (filename, None,
+    error message) for files which couldn't be checked.
+
+    """
+    try:
+        with open(filename, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as exc:
+        # mmap() refuses empty files with ValueError
+        return filename, None, str(exc)
+
+    try:
+        if cache is not None:
+            return filename, cache.process(mapping, checks), None
+        return filename, check_image(mapping, checks=checks), None
+    except (ELFError, IOError) as exc:
+        return filename, None, str(exc)
+    finally:
+        mapping.close()
+
+
+def format_result(result, opformat="csv", filename=None):
+    if opformat == "ndjson":
+        record = result.as_dict()
+        if filename is not None:
+            record["name"] = filename
+        return json.dumps(record, sort_keys=True)
+    if filename is not None:
+        return "%s,%s" % (filename, result)
+    return str(result)
+
+
+# result cache of the pool workers, inherited from check_paths()
+_worker_cache = None
+
+
+def _init_worker(cache):
+    global _worker_cache
+    _worker_cache = cache
+
+
+def _check_path_worker(filename, checks=None):
+    return check_path(filename, checks, _worker_cache)
+
+
+def check_paths(filenames, checks=None, jobs=1, chunksize=16, ordered=True,
+                cache=None):
+    """
+    Generate check_path() results for filenames, using a pool of jobs
+    worker processes (one per CPU when jobs is 0) which are handed the
+    files in chunks of chunksize. Results come in input order unless
+    ordered is False.
+
+    """
+    if jobs == 1:
+        check = partial(check_path, checks=checks, cache=cache)
+        for ret in six.moves.map(check, filenames):
+            yield ret
+        return
+
+    check = partial(_check_path_worker, checks=checks)
+    pool = multiprocessing.Pool(jobs or None, _init_worker, (cache,))
+    try:
+        if ordered:
+            results = pool.imap(check, filenames, chunksize)
+        else:
+            results = pool.imap_unordered(check, filenames, chunksize)
+        for ret in results:
+            yield ret
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check ELF files for security hardening features, "
+        "reads a single file from stdin when no files are given.")
+    parser.add_argument("files", nargs="*", help="ELF files to check")
+    parser.add_argument("--checks", type=checks_argument, default=None,
+                        help="comma separated list of checks to run "
+                        "(default: all), from %s" % ",".join(CHECK_NAMES))
+    parser.add_argument("-f", "--format", dest="opformat", default="csv",
+                        choices=("csv", "ndjson"), help="output format")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes, 0 means one per "
+                        "CPU (default: 1)")
+    parser.add_argument("--chunksize", type=int, default=16,
+                        help="files handed to a worker at a time")
+    parser.add_argument("--unordered", action="store_true",
+                        help="print results as soon as they are ready "
+                        "instead of in command line order")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="cache results by file content in this "
+                        "sqlite database")
+    parser.add_argument("--cache-size", type=int, default=256,
+                        metavar="MB", help="maximum size of the result "
+                        "cache (default: 256)")
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        from resultcache import ResultCache
+        cache = ResultCache(args.cache, args.cache_size * 1024 * 1024)
+
+    if not args.files:
         try:
             if six.PY3:
                 import io
@@ -301,7 +709,7 @@ if __name__ == "__main__":
                 fh = io.BytesIO(sys.stdin.read())
             else:
                 fh = cStringIO(sys.stdin.read())
-            elf = Elf(fh)
+            out = check_image(fh, checks=args.checks)
 
         except ELFError as exc:
             print("%s,Not an ELF binary" % str(exc), file=sys.stderr)
@@ -310,22 +718,23 @@ if __name__ == "__main__":
             print("%s,Not an ELF binary" % str(exc), file=sys.stderr)
             sys.exit(-1)
 
-        print(process_file(elf))
+        print(format_result(out, args.opformat))
 
     else:
-        for i in range(1, len(sys.argv)):
-            try:
-                filename = sys.argv[i]
-                elf = Elf(open(filename, "rb"))
-            except ELFError as exc:
-                print(
-                    "%s,%s,Not an ELF binary" %
-                    (filename, str(exc)), file=sys.stderr)
-                continue
-            except IOError as exc:
+        results = check_paths(args.files, args.checks, args.jobs,
+                              args.chunksize, not args.unordered, cache)
+        for filename, out, error in results:
+            if out is None:
                 print(
                     "%s,%s,Not an ELF binary" %
-                    (filename, str(exc)), file=sys.stderr)
+                    (filename, error), file=sys.stderr)
                 continue
 
-            print("%s,%s" % (filename, process_file(elf)))
+            print(format_result(out, args.opformat, filename))
+
+        if cache is not None:
+            cache.report()
+
+
+if __name__ == "__main__":
+    main()
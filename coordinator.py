@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""
+Work-stealing coordinator for scans spread over several hosts.
+
+The coordinator serves the packages of a repository listing to any number
+of scanner.py workers (scanner.py --coordinator ADDRESS), which pull them
+in small batches as their pools run dry and report every package they
+finish. A fast host thus keeps taking work until nothing is left, instead
+of idling once its static shard is done.
+
+Every package served is leased to the connection which took it. The lease
+is reassigned (served again to whoever asks next) when that connection
+closes, when the worker process dies, or when the worker stops renewing
+its leases for lease_timeout seconds because its host is gone. Completions
+are only accepted once per package, and only for packages which were
+served. A worker outputs a package's record only when its completion was
+accepted, so every package shows up exactly once across the outputs of
+all workers.
+
+The protocol is one JSON object per line, in both directions, over TCP
+("host:port") or a Unix socket (any other address):
+
+    {"op": "hello", "worker": NAME}     -> {"lease_timeout": SECONDS}
+    {"op": "take", "count": N}          -> {"paths": [PATH, ...]}
+                                           {"paths": [], "wait": SECONDS}
+                                           {"paths": [], "done": true}
+    {"op": "done", "path": PATH}        -> {"accepted": BOOL}
+    {"op": "renew"}                     -> {}
+
+Paths are relative to the repository, every host passes its own mount
+point of it.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+from collections import deque
+
+from six.moves import socketserver
+
+from scheduler import walk, file_size
+from sharding import scanned_rpm
+
+# seconds a worker waits before asking again when everything is leased
+RETRY_INTERVAL = 1.0
+
+
+def parse_address(value):
+    """(family, address) for "host:port" or a Unix socket path"""
+    host, _, port = value.rpartition(":")
+    if host and port.isdigit() and "/" not in value:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, value
+
+
+def listing(path):
+    """
+    Paths of the packages to scan, relative to the repository: the lines
+    of the listing file path, or the RPM packages below the directory path
+    (scanner.py is the only worker).
+
+    """
+    if os.path.isdir(path):
+        return [os.path.relpath(filename, path)
+                for filename in walk(path, scanned_rpm)]
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class Coordinator(object):
+    def __init__(self, paths, lease_timeout=600.0, output=sys.stderr):
+        self.pending = deque(paths)
+        self.total = len(self.pending)
+        self.lease_timeout = lease_timeout
+        self.output = output
+        # path -> (connection, deadline)
+        self.leases = {}
+        # every path leased so far, only these can be completed
+        self.served = set()
+        self.finished = set()
+        # whether a worker was told that everything is done
+        self.told = False
+        self.reassigned = 0
+        self.rejected = 0
+        self.lock = threading.Condition()
+
+    def done(self):
+        return len(self.finished) == self.total
+
+    def take(self, connection, count):
+        with self.lock:
+            self._expire()
+            paths = []
+            while self.pending and len(paths) < count:
+                path = self.pending.popleft()
+                if path in self.finished:
+                    continue
+                self.leases[path] = (connection,
+                                     time.time() + self.lease_timeout)
+                self.served.add(path)
+                paths.append(path)
+            if paths:
+                return {"paths": paths}
+            if self.done():
+                self.told = True
+                self.lock.notify_all()
+                return {"paths": [], "done": True}
+            return {"paths": [], "wait": RETRY_INTERVAL}
+
+    def complete(self, connection, path):
+        with self.lock:
+            if path in self.finished or path not in self.served:
+                self.rejected += 1
+                return {"accepted": False}
+            # a late completion of an expired lease still counts, the
+            # package is done either way
+            self.leases.pop(path, None)
+            self.finished.add(path)
+            self.lock.notify_all()
+            return {"accepted": True}
+
+    def renew(self, connection):
+        with self.lock:
+            deadline = time.time() + self.lease_timeout
+            for path, (holder, _) in self.leases.items():
+                if holder is connection:
+                    self.leases[path] = (holder, deadline)
+        return {}
+
+    def release(self, connection, reason):
+        """Reassign the leases of connection"""
+        with self.lock:
+            self._reassign([path for path, (holder, _) in self.leases.items()
+                            if holder is connection], reason)
+
+    def _expire(self):
+        now = time.time()
+        self._reassign([path for path, (_, deadline) in self.leases.items()
+                        if deadline < now], "lease expired")
+
+    def _reassign(self, paths, reason):
+        for path in paths:
+            connection, _ = self.leases.pop(path)
+            self.reassigned += 1
+            print("[*] %s: reassigning %s (%s)" % (connection.name, path,
+                                                   reason),
+                  file=self.output)
+        # first in line, they have been waiting for a while already
+        self.pending.extendleft(reversed(paths))
+
+    def wait(self):
+        """
+        Block until every package is done. With nothing to serve at all,
+        block until a worker was told so instead, workers starting with
+        the coordinator would find it gone otherwise.
+
+        """
+        with self.lock:
+            while not self.done() or not (self.total or self.told):
+                self.lock.wait(1.0)
+                self._expire()
+
+    def report(self, output=sys.stderr):
+        print("[+] coordinator: %d packages done, %d reassigned, %d "
+              "duplicate or unknown completions rejected" %
+              (len(self.finished), self.reassigned, self.rejected),
+              file=output)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """One worker connection"""
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        self.name = "worker %s" % (self.client_address or "?",)
+        reason = "connection closed"
+        try:
+            for line in self.rfile:
+                request = json.loads(line.decode("utf-8"))
+                op = request.get("op")
+                if op == "hello":
+                    self.name = request.get("worker", self.name)
+                    reply = {"lease_timeout": coordinator.lease_timeout}
+                elif op == "take":
+                    reply = coordinator.take(self, request.get("count", 1))
+                elif op == "done":
+                    reply = coordinator.complete(self, request["path"])
+                elif op == "renew":
+                    reply = coordinator.renew(self)
+                else:
+                    reply = {"error": "unknown op %r" % (op,)}
+                self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+                self.wfile.flush()
+        except (ValueError, KeyError, socket.error) as exc:
+            reason = str(exc)
+        finally:
+            coordinator.release(self, reason)
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingMixIn,
+                 socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(coordinator, address):
+    """Serve coordinator on address until every package is done"""
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.unlink(address)
+    server = (UnixServer if family == socket.AF_UNIX else TCPServer)(
+        address, Handler)
+    server.coordinator = coordinator
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        coordinator.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if family == socket.AF_UNIX:
+            os.unlink(address)
+
+
+class Client(object):
+    """
+    Worker side of the protocol. Leases are renewed by a background
+    thread, requests can be made from any thread.
+
+    """
+
+    def __init__(self, address, worker=None):
+        family, address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile("rb")
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        worker = worker or "%s:%d" % (socket.gethostname(), os.getpid())
+        reply = self.request(op="hello", worker=worker)
+        self.renewer = threading.Thread(target=self._renew,
+                                        args=(reply["lease_timeout"] / 3.0,))
+        self.renewer.daemon = True
+        self.renewer.start()
+
+    def request(self, **request):
+        with self.lock:
+            self.sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            line = self.rfile.readline()
+        if not line:
+            raise socket.error("coordinator closed the connection")
+        return json.loads(line.decode("utf-8"))
+
+    def _renew(self, interval):
+        while not self.closed.wait(interval):
+            try:
+                self.request(op="renew")
+            except socket.error:
+                return
+
+    def paths(self, count=1):
+        """Generate the paths served to this worker until none are left"""
+        while True:
+            try:
+                reply = self.request(op="take", count=count)
+            except socket.error:
+                # the coordinator is gone once everything is done
+                return
+            for path in reply["paths"]:
+                yield path
+            if reply.get("done"):
+                return
+            if not reply["paths"]:
+                time.sleep(reply.get("wait", RETRY_INTERVAL))
+
+    def done(self, path):
+        """Report path as done, returns whether this worker owns the
+        result. Without an answer it doesn't: the coordinator serves the
+        package again once the connection is gone, or it had every
+        package done already when it went away."""
+        try:
+            return self.request(op="done", path=path)["accepted"]
+        except socket.error as exc:
+            print("[-] coordinator: %s, dropping %s" % (exc, path),
+                  file=sys.stderr)
+            return False
+
+    def close(self):
+        self.closed.set()
+        # the file object keeps the socket open otherwise, and the
+        # coordinator wouldn't see us leave
+        self.rfile.close()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the packages of a "
+                                     "repository to scanner.py workers")
+    parser.add_argument("listing", help="repository directory, or a file "
+                        "listing package paths relative to the repository, "
+                        "one per line")
+    parser.add_argument("address", help="host:port to listen on, or the "
+                        "path of a Unix socket")
+    parser.add_argument("--root", metavar="PATH",
+                        help="repository directory, to order the packages "
+                        "of a listing file largest first")
+    parser.add_argument("--lease-timeout", type=float, default=600.0,
+                        metavar="SECONDS", help="reassign the packages of "
+                        "a worker which didn't renew its leases for this "
+                        "long (default: 600)")
+    args = parser.parse_args()
+
+    paths = listing(args.listing)
+    root = args.listing if os.path.isdir(args.listing) else args.root
+    if root is not None:
+        # giant packages first, so that they don't end up running alone
+        # at the end of the scan
+        paths.sort(key=lambda path: file_size(os.path.join(root, path)),
+                   reverse=True)
+    coordinator = Coordinator(paths, args.lease_timeout)
+    print("[+] coordinator: serving %d packages on %s" %
+          (len(paths), args.address), file=sys.stderr)
+    serve(coordinator, args.address)
+    coordinator.report()
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,11 @@ http://archive.ubuntu.com/ubuntu/dists/raring/
 
 """
 
-from checksec import process_file, Elf
+from checksec import check_image
+from resultcache import ResultCache
+from scheduler import run_jobs, default_workers, walk, file_size
+from sharding import shard_argument, in_shard, source
+from elfheader import read_elf
 from elftools.common.exceptions import ELFError
 
 try:
@@ -31,12 +35,14 @@ from io import BytesIO
 import os
 import stat
 import json
-import multiprocessing
+import argparse
 
 BASE_URL = "http://archive.ubuntu.com/ubuntu/"
 database = {}
 sections = {}
 opformat = "csv"
+cache = None
+shard = None
 
 def analyze(debfile, package="?", group="?", show_errors=False):
     deb = DebFile(filename=debfile)
@@ -91,16 +97,20 @@ def analyze(debfile, package="?", group="?", show_errors=False):
             continue
 
         try:
-            contents = tgz.extractfile(entry).read()
+            contents = read_elf(tgz.extractfile(entry))
         except Exception as exc:
             print(exc)
+            continue
+        if contents is None:
+            continue
 
         # invoke checksec
         returncode = -1
         try:
-            fh = BytesIO(contents)
-            elf = Elf(fh)
-            out = process_file(elf)
+            if cache is not None:
+                out = cache.process(contents)
+            else:
+                out = check_image(BytesIO(contents))
             returncode = 0
             dataline = "%s,%s,%s,%s" % (package, os.path.basename(debfile),
                                         filename, out)
@@ -122,18 +132,26 @@ def analyze(debfile, package="?", group="?", show_errors=False):
         if returncode == 0 and opformat == "csv":
             print(dataline)
         if returncode == 0 and opformat == "json":
-            try:
-                for kvp in out.rstrip().split(","):
-                    key, value = kvp.split("=")
-                    fileinfo[key] = value
-            except Exception:
-                pass
+            fileinfo.update(out.as_dict())
 
         if opformat == "json":
             print(json.dumps(output, sort_keys=True, indent=4,
                          separators=(',', ': ')))
 
 
+def wanted(debfile):
+    if not debfile.endswith(".deb"):
+        return False
+    if shard is None:
+        return True
+    return in_shard(source(debfile), shard)
+
+
+def output_callback(result):
+    if result:
+        print(result)
+
+
 def profile_main():
     # Run 'main' redirecting its output to readelfout.txt
     # Saves profiling information in readelf.profile
@@ -148,50 +166,59 @@ def profile_main():
 
 
 def main():
-    if len(sys.argv) < 2:
-        sys.stderr.write("Usage: %s <path to .deb files> " \
-            "[output format (csv / json)] [existing JSON file]\n" \
-            % sys.argv[0])
-        sys.exit(-1)
-
-    path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Fast .deb analysis tool")
+    parser.add_argument("path", help="path to .deb files")
+    parser.add_argument("opformat", nargs="?", default="csv",
+                        help="output format (csv / json)")
+    parser.add_argument("existing", nargs="?",
+                        help="existing JSON file")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="cache ELF results by content in this sqlite "
+                        "database")
+    parser.add_argument("--cache-size", type=int, default=256,
+                        metavar="MB", help="maximum size of the result "
+                        "cache (default: 256)")
+    parser.add_argument("-j", "--jobs", type=int, default=default_workers(),
+                        help="number of worker processes (default: number "
+                        "of CPUs)")
+    parser.add_argument("--adaptive", type=int, default=None, metavar="MIN",
+                        help="adapt the number of packages analysed at once "
+                        "between MIN and --jobs to the CPU and I/O wait "
+                        "load")
+    parser.add_argument("--shard", type=shard_argument, default=None,
+                        metavar="i/N", help="only scan shard i (counting "
+                        "from 0) of N, by a stable hash of the source "
+                        "package name (see shard-merge.py)")
+    args = parser.parse_args()
+
+    path = args.path
 
     global opformat
-    if (len(sys.argv) > 2):
-        opformat = sys.argv[2]
-    else:
-        opformat = "csv"
+    opformat = args.opformat
 
-    parallel = True
-    # parallel = False
-    if parallel:
-        p = multiprocessing.Pool(4)
+    global shard
+    shard = args.shard
+
+    global cache
+    if args.cache:
+        # cache.report() at the end covers the workers run_jobs() forks,
+        # they count into the counters of this instance
+        cache = ResultCache(args.cache, args.cache_size * 1024 * 1024)
 
-    output = {}
     if(os.path.isfile(path)):
         sys.stderr.write("Analyzing %s ...\n" % path)
         out = analyze(path)
         if out:
             print(out)
     else:
-        for (path, _, files) in os.walk(path):
-            for fname in files:
-                debfile = os.path.join(path, fname)
-                #if os.path.basename(debfile) in data:
-                    # print >> sys.stderr, "Skipping", debfile
-                #    pass
-                # else:
-                if parallel:
-                    output[debfile] = p.apply_async(analyze, (debfile,))
-                else:
-                    out = analyze(debfile)
-                    if out:
-                        print(out)
-
-            if parallel:
-                for debfile, result in output.items():
-                    sys.stderr.write("Analyzing %s ...\n" % debfile)
-                    print(result.get())
+        jobs = ((file_size(debfile), (debfile,))
+                for debfile in walk(path, wanted))
+        stats = run_jobs(analyze, jobs, args.jobs, callback=output_callback,
+                         adaptive=args.adaptive)
+        stats.report()
+
+    if cache is not None:
+        cache.report()
 
 if __name__ == "__main__":
     main()
@@ -16,7 +16,8 @@ http://archive.ubuntu.com/ubuntu/dists/raring/
 
 """
 
-from checksec import process_file, Elf
+from checksec import check_image
+from elfheader import read_elf
 from elftools.common.exceptions import ELFError
 
 try:
@@ -99,16 +100,17 @@ def analyze(debfile, package="?", group="?", show_errors=False):
             continue
 
         try:
-            contents = tgz.extractfile(entry).read()
+            contents = read_elf(tgz.extractfile(entry))
         except Exception as exc:
             print(exc)
+            continue
+        if contents is None:
+            continue
 
         # invoke checksec
         returncode = -1
         try:
-            fh = BytesIO(contents)
-            elf = Elf(fh)
-            out = process_file(elf)
+            out = check_image(BytesIO(contents))
             returncode = 0
         except ELFError as exc:
             continue
@@ -126,12 +128,7 @@ def analyze(debfile, package="?", group="?", show_errors=False):
                 fileinfo["directory"] = directory
             output["files"].append(fileinfo)
         if returncode == 0 and opformat == "json":
-            try:
-                for kvp in out.rstrip().split(","):
-                    key, value = kvp.split("=")
-                    fileinfo[key] = value
-            except Exception:
-                pass
+            fileinfo.update(out.as_dict())
 
     print(json.dumps(output, sort_keys=True, indent=4,
                          separators=(',', ': ')))
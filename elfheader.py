@@ -0,0 +1,368 @@
+"""
+Lightweight ELF header parser.
+
+NX, RELRO, PIE and the dynamic tag checks only need the ELF header, the
+program headers and the PT_DYNAMIC segment. Building a full pyelftools
+ELFFile object graph for them is expensive, so this module unpacks those
+tables straight from a buffer (bytes, mmap or memoryview) with
+precompiled struct formats.
+
+The tables come from the file and may be hostile: parsing is bounded by
+the size of the buffer (offsets past its end mean the file is truncated)
+and by limits on the number of segments, sections and symbols, on the
+size of symbol string tables and on the total number of bytes scanned.
+Going over any of them raises ElfLimit.
+
+"""
+
+import re
+import struct
+
+from elftools.common.exceptions import ELFError
+from elftools.common.py3compat import bytes2str
+
+ELFMAG = b"\x7fELF"
+
+ET_DYN = 3
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_GNU_STACK = 0x6474e551
+PT_GNU_RELRO = 0x6474e552
+
+PF_X = 0x1
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+SHN_XINDEX = 0xffff
+
+DT_NULL = 0
+DT_STRTAB = 5
+DT_STRSZ = 10
+
+# d_tag values we know by name, the index keeps the rest as numbers
+D_TAGS = {
+    1: "DT_NEEDED", 2: "DT_PLTRELSZ", 3: "DT_PLTGOT", 4: "DT_HASH",
+    5: "DT_STRTAB", 6: "DT_SYMTAB", 7: "DT_RELA", 8: "DT_RELASZ",
+    9: "DT_RELAENT", 10: "DT_STRSZ", 11: "DT_SYMENT", 12: "DT_INIT",
+    13: "DT_FINI", 14: "DT_SONAME", 15: "DT_RPATH", 16: "DT_SYMBOLIC",
+    17: "DT_REL", 18: "DT_RELSZ", 19: "DT_RELENT", 20: "DT_PLTREL",
+    21: "DT_DEBUG", 22: "DT_TEXTREL", 23: "DT_JMPREL", 24: "DT_BIND_NOW",
+    25: "DT_INIT_ARRAY", 26: "DT_FINI_ARRAY", 27: "DT_INIT_ARRAYSZ",
+    28: "DT_FINI_ARRAYSZ", 29: "DT_RUNPATH", 30: "DT_FLAGS",
+    0x6ffffef5: "DT_GNU_HASH", 0x6ffffff0: "DT_VERSYM",
+    0x6ffffffb: "DT_FLAGS_1", 0x6ffffffe: "DT_VERNEED",
+    0x6fffffff: "DT_VERNEEDNUM"}
+
+# d_tag values whose d_val is an offset into the dynamic string table
+D_STRINGS = set([1, 14, 15, 29])
+
+# parsing limits, far above what real binaries need
+MAX_SEGMENTS = 4096
+MAX_SECTIONS = 65536
+MAX_SYMBOLS = 4 * 1024 * 1024
+MAX_STRTAB = 256 * 1024 * 1024
+# bytes which may be scanned (symbol tables, symbol names, string
+# sections, ...), as a multiple of the file size plus a minimum
+MAX_BYTES_FACTOR = 4
+MIN_BYTES = 1024 * 1024
+
+_IDENT = struct.Struct("4sBB")
+_CSTRING = re.compile(b"[^\0]*")
+
+
+def read_elf(f):
+    """
+    Contents of the file object f (an archive member, ...) if it starts
+    with the ELF magic, None otherwise. Only the magic of other files is
+    read, so their data is never decompressed and copied out in full.
+
+    """
+    contents = f.read(len(ELFMAG))
+    if contents != ELFMAG:
+        return None
+    return contents + f.read()
+
+
+class ElfLimit(ELFError):
+    """
+    The file is truncated or malformed, or parsing it would go over one
+    of the limits above. Checks report it as their verdict instead of
+    failing, and it is never taken for a file which isn't ELF at all.
+
+    """
+
+
+class _Formats(object):
+    """Precompiled struct formats for one ELF class and byte order."""
+    def __init__(self, elfclass, endian):
+        if elfclass == 64:
+            self.ehdr = struct.Struct(endian + "16sHHIQQQIHHHHHH")
+            # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, ...
+            self.phdr = struct.Struct(endian + "IIQQQQQQ")
+            self.shdr = struct.Struct(endian + "IIQQQQIIQQ")
+            self.dyn = struct.Struct(endian + "qQ")
+        else:
+            # p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags
+            self.phdr = struct.Struct(endian + "IIIIIIII")
+            self.ehdr = struct.Struct(endian + "16sHHIIIIIHHHHHH")
+            self.shdr = struct.Struct(endian + "IIIIIIIIII")
+            self.dyn = struct.Struct(endian + "iI")
+        # st_name, the first field of Elf32_Sym and Elf64_Sym
+        self.st_name = struct.Struct(endian + "I")
+        self.sym_size = 24 if elfclass == 64 else 16
+        self.elfclass = elfclass
+
+
+FORMATS = {
+    (1, 1): _Formats(32, "<"), (1, 2): _Formats(32, ">"),
+    (2, 1): _Formats(64, "<"), (2, 2): _Formats(64, ">")}
+
+
+class Segment(object):
+    __slots__ = ("p_type", "p_flags", "p_offset", "p_vaddr", "p_filesz")
+
+    def __init__(self, p_type, p_flags, p_offset, p_vaddr, p_filesz):
+        self.p_type = p_type
+        self.p_flags = p_flags
+        self.p_offset = p_offset
+        self.p_vaddr = p_vaddr
+        self.p_filesz = p_filesz
+
+
+class Section(object):
+    __slots__ = ("name", "sh_type", "sh_offset", "sh_size", "sh_link",
+                 "sh_entsize")
+
+    def __init__(self, name, sh_type, sh_offset, sh_size, sh_link=0,
+                 sh_entsize=0):
+        self.name = name
+        self.sh_type = sh_type
+        self.sh_offset = sh_offset
+        self.sh_size = sh_size
+        self.sh_link = sh_link
+        self.sh_entsize = sh_entsize
+
+
+class ElfHeader(object):
+    """
+    ELF header, program headers and PT_DYNAMIC of the ELF image in buf.
+
+    Raises ELFError (like pyelftools' ELFFile does) for anything which
+    isn't an ELF file, and ElfLimit for tables which are truncated, too
+    large or malformed, as they are parsed.
+
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        if len(buf) < 16:
+            raise ELFError("Magic number does not match")
+        magic, elfclass, data = _IDENT.unpack_from(buf, 0)
+        if magic != ELFMAG:
+            raise ELFError("Magic number does not match")
+        formats = FORMATS.get((elfclass, data))
+        if formats is None:
+            raise ELFError("Invalid EI_CLASS %d / EI_DATA %d" %
+                           (elfclass, data))
+        self.formats = formats
+        self.elfclass = formats.elfclass
+
+        (_, self.e_type, self.e_machine, _, _, self.e_phoff, self.e_shoff,
+         _, _, self.e_phentsize, self.e_phnum, self.e_shentsize,
+         self.e_shnum, self.e_shstrndx) = self._unpack(formats.ehdr, 0)
+
+        self._segments = None
+        self._sections = None
+        self._dynamic = None
+        self.symbol_count = 0
+        self.touched = 0
+        self.max_bytes = MAX_BYTES_FACTOR * len(buf) + MIN_BYTES
+
+    def _unpack(self, fmt, offset):
+        if offset < 0 or offset + fmt.size > len(self.buf):
+            raise ElfLimit("truncated at offset %d" % offset)
+        return fmt.unpack_from(self.buf, offset)
+
+    def touch(self, size):
+        """Account for scanning size more bytes of the file"""
+        self.touched += size
+        if self.touched > self.max_bytes:
+            raise ElfLimit("more than %d bytes scanned" % self.max_bytes)
+
+    def within(self, offset, size):
+        """Make sure offset:offset + size is inside the file"""
+        if offset < 0 or offset + size > len(self.buf):
+            raise ElfLimit("truncated at offset %d" % (offset + size))
+
+    @property
+    def segments(self):
+        """Program headers, parsed on demand"""
+        if self._segments is None:
+            self._segments = self._parse_segments()
+        return self._segments
+
+    def _parse_segments(self):
+        phdr = self.formats.phdr
+        if self.e_phnum and self.e_phentsize < phdr.size:
+            raise ElfLimit("invalid e_phentsize %d" % self.e_phentsize)
+        if self.e_phnum > MAX_SEGMENTS:
+            raise ElfLimit("%d segments" % self.e_phnum)
+
+        segments = []
+        for i in range(self.e_phnum):
+            fields = self._unpack(phdr, self.e_phoff + i * self.e_phentsize)
+            if self.elfclass == 64:
+                p_type, p_flags, p_offset, p_vaddr, _, p_filesz = fields[:6]
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, _, p_flags = \
+                    fields[:7]
+            segments.append(Segment(p_type, p_flags, p_offset, p_vaddr,
+                                    p_filesz))
+        return segments
+
+    def num_segments(self):
+        return len(self.segments)
+
+    def segments_of(self, p_type):
+        return [s for s in self.segments if s.p_type == p_type]
+
+    def _offset_of(self, vaddr):
+        """Translate a virtual address into a file offset."""
+        for segment in self.segments:
+            if segment.p_type != PT_LOAD:
+                continue
+            if segment.p_vaddr <= vaddr < segment.p_vaddr + segment.p_filesz:
+                return vaddr - segment.p_vaddr + segment.p_offset
+        return None
+
+    def _string(self, offset, end):
+        end = min(end, len(self.buf))
+        if offset is None or offset >= end:
+            return None
+        return bytes2str(_CSTRING.match(self.buf, offset, end).group(0))
+
+    def dynamic(self):
+        """
+        Decode PT_DYNAMIC into a {d_tag name: [values]} index, string
+        valued tags are resolved through DT_STRTAB.
+
+        """
+        if self._dynamic is not None:
+            return self._dynamic
+
+        entries = []
+        dyn = self.formats.dyn
+        for segment in self.segments_of(PT_DYNAMIC):
+            self.within(segment.p_offset, segment.p_filesz)
+            self.touch(segment.p_filesz)
+            end = segment.p_offset + segment.p_filesz
+            for offset in range(segment.p_offset, end - dyn.size + 1,
+                                dyn.size):
+                d_tag, d_val = dyn.unpack_from(self.buf, offset)
+                if d_tag == DT_NULL:
+                    break
+                entries.append((d_tag, d_val))
+
+        strtab = strsz = None
+        for d_tag, d_val in entries:
+            if d_tag == DT_STRTAB:
+                strtab = self._offset_of(d_val)
+            elif d_tag == DT_STRSZ:
+                strsz = d_val
+
+        index = {}
+        for d_tag, d_val in entries:
+            if d_tag in D_STRINGS:
+                if strtab is None:
+                    continue
+                end = strtab + strsz if strsz is not None else len(self.buf)
+                d_val = self._string(strtab + d_val, end)
+                if d_val is None:
+                    continue
+            index.setdefault(D_TAGS.get(d_tag, d_tag), []).append(d_val)
+        self._dynamic = index
+        return index
+
+    def sections(self):
+        """Section headers with their names resolved, parsed on demand."""
+        if self._sections is not None:
+            return self._sections
+
+        if not self.e_shoff:
+            self._sections = []
+            return self._sections
+
+        shdr = self.formats.shdr
+        if self.e_shentsize < shdr.size:
+            raise ElfLimit("invalid e_shentsize %d" % self.e_shentsize)
+
+        def header(i):
+            return self._unpack(shdr, self.e_shoff + i * self.e_shentsize)
+
+        shnum, shstrndx = self.e_shnum, self.e_shstrndx
+        if shnum == 0 or shstrndx == SHN_XINDEX:
+            # extended numbering, the real values live in section 0
+            first = header(0)
+            shnum = shnum or first[5]
+            if shstrndx == SHN_XINDEX:
+                shstrndx = first[6]
+
+        if shnum > MAX_SECTIONS:
+            raise ElfLimit("%d sections" % shnum)
+        headers = [header(i) for i in range(shnum)]
+        strtab = None
+        if shstrndx != SHN_UNDEF and shstrndx < shnum:
+            strtab = headers[shstrndx]
+
+        sections = []
+        for fields in headers:
+            sh_name, sh_type, sh_offset, sh_size, sh_link, sh_entsize = \
+                fields[0], fields[1], fields[4], fields[5], fields[6], \
+                fields[9]
+            name = None
+            if strtab is not None:
+                name = self._string(strtab[4] + sh_name,
+                                    strtab[4] + strtab[5])
+            sections.append(Section(name, sh_type, sh_offset, sh_size,
+                                    sh_link, sh_entsize))
+        self._sections = sections
+        return sections
+
+    def symbol_tables(self):
+        """The SHT_SYMTAB and SHT_DYNSYM sections"""
+        return [section for section in self.sections()
+                if section.sh_type in (SHT_SYMTAB, SHT_DYNSYM)]
+
+    def symbol_names(self, section):
+        """
+        Generate the names of the symbols in the symbol table section,
+        None for symbols whose name isn't inside the string table.
+
+        """
+        sections = self.sections()
+        if section.sh_entsize < self.formats.sym_size:
+            raise ElfLimit("invalid sh_entsize %d" % section.sh_entsize)
+        count = section.sh_size // section.sh_entsize
+        self.within(section.sh_offset, section.sh_size)
+        self.symbol_count += count
+        if self.symbol_count > MAX_SYMBOLS:
+            raise ElfLimit("%d symbols" % self.symbol_count)
+        if section.sh_link >= len(sections):
+            raise ElfLimit("invalid sh_link %d" % section.sh_link)
+        strtab = sections[section.sh_link]
+        if strtab.sh_size > MAX_STRTAB:
+            raise ElfLimit("%d byte string table" % strtab.sh_size)
+        self.within(strtab.sh_offset, strtab.sh_size)
+        self.touch(count * section.sh_entsize)
+
+        st_name = self.formats.st_name
+        start, end = strtab.sh_offset, strtab.sh_offset + strtab.sh_size
+        for i in range(count):
+            offset = section.sh_offset + i * section.sh_entsize
+            name = self._string(start + st_name.unpack_from(self.buf,
+                                                            offset)[0], end)
+            if name is not None:
+                self.touch(len(name) + 1)
+            yield name
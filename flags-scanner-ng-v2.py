@@ -31,8 +31,10 @@ except ImportError, exc:
 
 import os
 import stat
-import multiprocessing
+import argparse
 import threading
+from scheduler import run_jobs, file_size, default_workers
+from sharding import shard_argument, in_shard, source
 
 # global stuff
 debug_packages = {}
@@ -75,8 +77,6 @@ def debuginfo_parser(adebug_package, filename):
         print(adebug_package, str(exc))
         traceback.print_exc()
 
-results = []
-
 
 def analyze(rpmfile):
     """Analyse single RPM file"""
@@ -249,16 +249,26 @@ def output_callback(result):
         if result:
             result, rpmfile = result
             shove[result["build"]] = result
-            results.append(rpmfile)
 
 
 def main():
-    if len(sys.argv) < 2:
-        sys.stderr.write(
-            "Usage: %s <path to RPM files>\n" % sys.argv[0])
-        sys.exit(-1)
-
-    path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Fast RPM analysis tool")
+    parser.add_argument("path", help="path to RPM files")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=2 * default_workers(),
+                        help="maximum number of worker processes (default: "
+                        "twice the number of CPUs)")
+    parser.add_argument("--adaptive", type=int, default=1, metavar="MIN",
+                        help="adapt the number of packages analysed at once "
+                        "between MIN and --jobs to the CPU and I/O wait "
+                        "load, 0 to always run --jobs of them (default: 1)")
+    parser.add_argument("--shard", type=shard_argument, default=None,
+                        metavar="i/N", help="only scan shard i (counting "
+                        "from 0) of N, by a stable hash of the source "
+                        "package name (see shard-merge.py)")
+    args = parser.parse_args()
+
+    path = args.path
 
     # make a list of all debuginfo packages
     for (path, _, files) in os.walk(path):
@@ -268,10 +278,10 @@ def main():
                 debug_packages[fname] = os.path.abspath(os.path.join(path,
                                                                      fname))
 
-    p = multiprocessing.Pool(4)
-    outputmap = {}
-
-    for (path, _, files) in os.walk(sys.argv[1]):
+    # dispatch the biggest packages first so that they don't end up
+    # running alone at the end of the scan
+    jobs = []
+    for (path, _, files) in os.walk(args.path):
         for fname in files:
             # is this a "debuginfo" package?
             if "-debuginfo-" in fname:
@@ -279,18 +289,16 @@ def main():
             rpmfile = os.path.abspath(os.path.join(path, fname))
             if not rpmfile.endswith(".rpm"):
                 continue
-            outputmap[rpmfile] = p.apply_async(
-                analyze,
-                [rpmfile],
-                callback=output_callback)
-            for ready in results:  # prevent FAST queue growth!
-                try:
-                    outputmap[ready].wait()
-                    del outputmap[ready]
-                except:
-                    pass
-    p.close()
-    p.join()
+            if args.shard is not None and \
+                    not in_shard(source(rpmfile), args.shard):
+                continue
+            jobs.append((file_size(rpmfile), [rpmfile]))
+
+    # start with a worker per CPU and let the controller find the number
+    # of workers the storage and the CPUs can keep busy
+    stats = run_jobs(analyze, jobs, args.jobs, callback=output_callback,
+                     adaptive=args.adaptive or None)
+    stats.report()
 
 if __name__ == "__main__":
     main()
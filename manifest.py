@@ -0,0 +1,133 @@
+"""
+Persistent manifest of scanned packages, for incremental rescans.
+
+Every build (package file name) is recorded with the size, mtime and header
+SHA1 of the file it was scanned from, the options it was scanned with and
+its results. On a rescan, builds whose size and mtime didn't change are
+skipped without being opened, and builds which were only touched or copied
+are recognised by their header SHA1.
+
+The manifest is a sqlite database, so every lookup is an indexed query and
+earlier results never have to be loaded into memory as a whole.
+
+"""
+
+from __future__ import print_function
+
+import sys
+import sqlite3
+import threading
+
+from checksec import CHECKER_VERSION, CHECK_NAMES
+
+# how many writes are batched into one transaction
+COMMIT_INTERVAL = 256
+
+# first bytes of every sqlite 3 database
+SQLITE_MAGIC = b"SQLite format 3\0"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    build TEXT NOT NULL,
+    options TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha1header TEXT,
+    result TEXT,
+    PRIMARY KEY (build, options)
+);
+"""
+
+
+def options(opformat, checks=None):
+    """
+    Identify the scan options, results are only reused for the same output
+    format, check selection and checker version.
+
+    """
+    if checks is None:
+        checks = CHECK_NAMES
+    return "%s:%s:%s" % (CHECKER_VERSION, opformat,
+                         ",".join(name for name in CHECK_NAMES
+                                  if name in checks))
+
+
+def is_manifest(path):
+    """
+    Whether path is an existing manifest, a sqlite database (the NDJSON
+    results of earlier scans aren't).
+
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except IOError:
+        return False
+
+
+class Manifest(object):
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.unchanged = 0
+        self.rescanned = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+        # used from the main thread and from the pool's result thread
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def lookup(self, build, size, mtime, sha1header=None):
+        """
+        Return the stored result of build if it can be reused for a file
+        with the given size and mtime, None otherwise.
+
+        A file with a different size or mtime still counts as unchanged if
+        sha1header() (only called in that case) returns the SHA1 of the
+        header it was scanned from.
+
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime, sha1header, result FROM builds "
+                "WHERE build = ? AND options = ?",
+                (build, self.options)).fetchone()
+        if row is None:
+            return None
+        if (row[0], row[1]) != (size, mtime):
+            if sha1header is None or row[2] is None or \
+               sha1header() != row[2]:
+                return None
+            with self._lock:
+                self._write("UPDATE builds SET size = ?, mtime = ? "
+                            "WHERE build = ? AND options = ?",
+                            (size, mtime, build, self.options))
+        self.unchanged += 1
+        return row[3]
+
+    def store(self, build, size, mtime, sha1header, result):
+        with self._lock:
+            self._write("INSERT OR REPLACE INTO builds (build, size, mtime, "
+                        "sha1header, options, result) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (build, size, mtime, sha1header, self.options,
+                         result))
+            self.rescanned += 1
+
+    def _write(self, statement, values):
+        try:
+            self._db.execute(statement, values)
+            self._writes += 1
+            if self._writes % COMMIT_INTERVAL == 0:
+                self._db.commit()
+        except sqlite3.Error as exc:
+            print("[-] manifest: %s" % exc, file=sys.stderr)
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def report(self, output=sys.stderr):
+        print("[+] manifest: %d unchanged, %d rescanned" %
+              (self.unchanged, self.rescanned), file=output)
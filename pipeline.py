@@ -0,0 +1,189 @@
+"""
+Two-stage decompress / analyse pipeline for the repository scanners.
+
+Decompression workers run the per-package job (scanner.analyze() and
+friends). Instead of parsing ELF members themselves, they copy each one
+into a multiprocessing.shared_memory block and hand its name to a separate
+pool of analysis workers, which run check_image() on a memoryview
+of the block without copying it again. Both stages are sized on their own
+and are connected by bounded queues, so a slow stage throttles the other
+one and the number of live shared memory blocks stays bounded.
+
+Pipeline has the submit() / close() / join() interface of BoundedPool, so
+scheduler.run_jobs() can drive it.
+
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import threading
+import traceback
+import multiprocessing
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+from checksec import check_image, BufferStream
+from elftools.common.exceptions import ELFError
+
+# the AnalysisStage of this decompression worker, None everywhere else
+stage = None
+
+
+class AnalysisStage(object):
+    """Decompression worker side of the handoff to the analysis workers"""
+
+    def __init__(self, index, tasks, replies):
+        self.index = index
+        self.tasks = tasks
+        self.replies = replies
+        self.tokens = 0
+        self.done = {}
+
+    def submit(self, contents, checks=None, key=None):
+        """
+        Queue contents (an ELF member) for analysis, blocking while the
+        analysis workers are behind. Returns a token for result().
+
+        """
+        shm = shared_memory.SharedMemory(create=True, size=len(contents))
+        try:
+            shm.buf[:len(contents)] = contents
+            self.tokens += 1
+            self.tasks.put((self.index, self.tokens, shm.name,
+                            len(contents), checks, key))
+        except Exception:
+            shm.unlink()
+            raise
+        finally:
+            # the analysis worker unlinks it once it is done
+            shm.close()
+        return self.tokens
+
+    def result(self, token):
+        """
+        Wait for the CheckResult of token. Raises ELFError for members the
+        analysis worker couldn't parse.
+
+        """
+        while token not in self.done:
+            got, ok, value = self.replies.get()
+            self.done[got] = ok, value
+        ok, value = self.done.pop(token)
+        if not ok:
+            raise ELFError(value)
+        return value
+
+
+def _analyse(tasks, replies, cache):
+    """Analysis worker"""
+    for index, token, name, size, checks, key in iter(tasks.get, None):
+        shm = shared_memory.SharedMemory(name=name)
+        view = shm.buf[:size]
+        try:
+            if cache is not None:
+                ret = True, cache.process(view, checks, key=key)
+            else:
+                ret = True, check_image(BufferStream(view), True, checks)
+        except (ELFError, IOError) as exc:
+            ret = False, str(exc)
+        except Exception:
+            ret = False, traceback.format_exc()
+        # every reference into the block must be gone before close()
+        view.release()
+        shm.close()
+        shm.unlink()
+        replies[index].put((token,) + ret)
+
+
+def _decompress(index, jobs, results, tasks, replies):
+    """Decompression worker, runs the jobs given to Pipeline.submit()"""
+    global stage
+    stage = AnalysisStage(index, tasks, replies[index])
+    for job, func, args in iter(jobs.get, None):
+        start = time.time()
+        try:
+            ret = True, func(*args)
+        except Exception:
+            ret = False, traceback.format_exc()
+        results.put((job,) + ret + (time.time() - start,))
+
+
+class Pipeline(object):
+    def __init__(self, processes, window=None, analysers=None, cache=None,
+                 queue_size=None):
+        if shared_memory is None:
+            raise RuntimeError("the pipeline needs Python 3.8 or later")
+        self.processes = processes
+        self.window = window or 2 * processes
+        analysers = analysers or processes
+        self.jobs = multiprocessing.Queue(self.window)
+        self.tasks = multiprocessing.Queue(queue_size or 2 * analysers)
+        self.results = multiprocessing.Queue()
+        replies = [multiprocessing.Queue() for _ in range(processes)]
+        self.callbacks = {}
+        self.submitted = 0
+        # blocks are created and unlinked in different workers, they have
+        # to share one resource tracker for that to add up
+        resource_tracker.ensure_running()
+
+        self.analysers = [
+            multiprocessing.Process(target=_analyse,
+                                    args=(self.tasks, replies, cache))
+            for _ in range(analysers)]
+        self.decompressors = [
+            multiprocessing.Process(target=_decompress,
+                                    args=(i, self.jobs, self.results,
+                                          self.tasks, replies))
+            for i in range(processes)]
+        for process in self.analysers + self.decompressors:
+            process.daemon = True
+            process.start()
+
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def _collect(self):
+        for job, ok, value, elapsed in iter(self.results.get, None):
+            func, args, callback, timer = self.callbacks.pop(job)
+            if timer is not None:
+                timer(elapsed)
+            if not ok:
+                print("[-] %s%s failed:\n%s" % (func.__name__, args, value),
+                      file=sys.stderr)
+            elif callback is not None:
+                callback(value)
+
+    def submit(self, func, args=(), callback=None, timer=None):
+        """
+        Run func(*args) in a decompression worker, like
+        BoundedPool.submit(). Blocks while the job queue is full.
+
+        """
+        self.submitted += 1
+        self.callbacks[self.submitted] = func, args, callback, timer
+        self.jobs.put((self.submitted, func, args))
+
+    def close(self):
+        for _ in self.decompressors:
+            self.jobs.put(None)
+
+    def join(self):
+        for process in self.decompressors:
+            process.join()
+        for _ in self.analysers:
+            self.tasks.put(None)
+        for process in self.analysers:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+
+    def terminate(self):
+        for process in self.decompressors + self.analysers:
+            process.terminate()
@@ -0,0 +1,222 @@
+"""
+Persistent, content-addressed cache of ELF analysis results.
+
+The same ELF bytes show up many times across a corpus (multilib and noarch
+duplicates, unchanged subpackages, rebuilds which didn't change binaries).
+Results are stored in a sqlite database keyed by content digest, checker
+version and check selection, and the least recently used entries are
+evicted once the database grows beyond max_size bytes.
+
+The cache object is meant to be created before the worker pool so that the
+workers inherit it (and its shared hit / miss counters) when forked, every
+process opens its own database connection.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import hashlib
+import sqlite3
+import multiprocessing
+from multiprocessing.util import Finalize
+
+from checksec import CheckResult, CHECKER_VERSION, CHECK_NAMES, \
+    check_image, BufferStream
+from elftools.common.exceptions import ELFError
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# stored for content which isn't an ELF file at all
+NOT_ELF = object()
+
+# how many writes happen between two eviction runs
+EVICT_INTERVAL = 256
+
+# how many hits are batched into one update of their access times
+TOUCH_INTERVAL = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value BLOB,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_atime ON results (atime);
+"""
+
+
+def digest(buf):
+    """Content digest of a buffer (bytes, mmap, memoryview)"""
+    return "sha256:" + hashlib.sha256(buf).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = multiprocessing.Value("L", 0)
+        self.misses = multiprocessing.Value("L", 0)
+        self._db = None
+        self._pid = None
+        self._writes = 0
+        # key -> access time of the hits not written yet
+        self._touched = {}
+
+    def _connect(self):
+        # connections can't be shared with forked workers
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+            self._pid = os.getpid()
+            self._writes = 0
+            self._touched = {}
+            # a pool worker leaves through os._exit(), the hits it batched
+            # are written by this finalizer rather than an atexit handler
+            Finalize(self, self.flush, exitpriority=10)
+        return self._db
+
+    @staticmethod
+    def key(content_digest, checks=None, deps=True):
+        """
+        Cache key for content_digest (like "sha256:<hex>" or any other
+        "<algorithm>:<hex>" digest) analysed with the given selection of
+        checks by the current checker version.
+
+        """
+        if checks is None:
+            checks = CHECK_NAMES if deps else CHECK_NAMES[:-1]
+        selection = ",".join(name for name in CHECK_NAMES if name in checks)
+        return "%s:%s:%s" % (CHECKER_VERSION, selection, content_digest)
+
+    def _count(self, counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def get(self, key):
+        """
+        Return the cached CheckResult (or NOT_ELF) for key, None on a
+        miss.
+
+        """
+        try:
+            db = self._connect()
+            row = db.execute("SELECT value FROM results WHERE key = ?",
+                             (key,)).fetchone()
+            if row is not None:
+                # a write transaction per hit would serialize the workers
+                # on the database lock
+                self._touched[key] = time.time()
+                if len(self._touched) >= TOUCH_INTERVAL:
+                    with db:
+                        self._touch(db)
+        except sqlite3.Error as exc:
+            print("[-] result cache: %s" % exc, file=sys.stderr)
+            row = None
+
+        if row is None:
+            self._count(self.misses)
+            return None
+        self._count(self.hits)
+        if row[0] is None:
+            return NOT_ELF
+        return CheckResult.from_bytes(row[0])
+
+    def put(self, key, result):
+        """Store a CheckResult (or NOT_ELF) under key."""
+        if result is NOT_ELF:
+            value, size = None, len(key)
+        else:
+            value = result.to_bytes()
+            size = len(key) + len(value)
+            value = sqlite3.Binary(value)
+        try:
+            db = self._connect()
+            with db:
+                db.execute("INSERT OR REPLACE INTO results "
+                           "(key, value, size, atime) VALUES (?, ?, ?, ?)",
+                           (key, value, size, time.time()))
+                self._touch(db)
+            self._writes += 1
+            if self._writes % EVICT_INTERVAL == 0:
+                self.evict()
+        except sqlite3.Error as exc:
+            print("[-] result cache: %s" % exc, file=sys.stderr)
+
+    def _touch(self, db):
+        """Update the access times of the pending hits, in the current
+        transaction of db"""
+        if self._touched:
+            db.executemany("UPDATE results SET atime = ? WHERE key = ?",
+                           [(atime, key)
+                            for key, atime in self._touched.items()])
+            self._touched = {}
+
+    def flush(self):
+        """Write the access times of the hits of this process"""
+        if not self._touched or self._pid != os.getpid():
+            return
+        try:
+            with self._db:
+                self._touch(self._db)
+        except sqlite3.Error as exc:
+            print("[-] result cache: %s" % exc, file=sys.stderr)
+
+    def evict(self):
+        """Drop least recently used entries until we fit in max_size."""
+        db = self._connect()
+        (total,) = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_size:
+            return
+        excess = total - self.max_size
+        victims = []
+        for key, size in db.execute("SELECT key, size FROM results "
+                                    "ORDER BY atime"):
+            if excess <= 0:
+                break
+            victims.append((key,))
+            excess -= size
+        with db:
+            db.executemany("DELETE FROM results WHERE key = ?", victims)
+
+    def process(self, contents, checks=None, deps=True, key=None):
+        """
+        check_image() for the ELF image in contents (any buffer), going
+        through the cache. Raises ELFError for content which isn't an ELF
+        file, just like Elf() does.
+
+        """
+        if key is None:
+            key = self.key(digest(contents), checks, deps)
+        result = self.get(key)
+        if result is NOT_ELF:
+            raise ELFError("Not an ELF binary (cached)")
+        if result is not None:
+            return result
+
+        try:
+            result = check_image(_stream(contents), deps, checks)
+        except ELFError:
+            self.put(key, NOT_ELF)
+            raise
+        self.put(key, result)
+        return result
+
+    def report(self, output=sys.stderr):
+        hits, misses = self.hits.value, self.misses.value
+        total = hits + misses
+        print("[+] result cache: %d hits, %d misses (%.1f%% hit rate)" %
+              (hits, misses, 100.0 * hits / total if total else 0.0),
+              file=output)
+
+
+def _stream(contents):
+    """File-like object over contents, for Elf()"""
+    if hasattr(contents, "seek"):
+        return contents
+    return BufferStream(contents)
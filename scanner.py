@@ -2,11 +2,24 @@
 
 """Fast RPM analysis tool"""
 
-from checksec import process_file, Elf
+from __future__ import print_function
+
+from checksec import check_image, checks_argument, CheckResult, \
+    CHECK_NAMES
+from resultcache import ResultCache, NOT_ELF
+from manifest import Manifest, options, is_manifest
+from scheduler import run_jobs, default_workers, walk, file_size, \
+    BoundedPool, Budget, finishing
+from shards import writer
+import shards
+import pipeline
+from sharding import shard_argument, in_shard, source, scanned_rpm
+from coordinator import Client
+from elfheader import ELFMAG
 from elftools.common.exceptions import ELFError
 
 import sys
-from six.moves import cStringIO
+from io import BytesIO
 
 try:
     import libarchive
@@ -23,42 +36,330 @@ except ImportError as exc:
 
 import os
 import json
+import argparse
 import stat
-import multiprocessing
 import threading
+import itertools
+import traceback
+import multiprocessing
+from functools import partial
 from collections import defaultdict
 
 # global stuff
-data = {}
 lock = threading.Lock()
+lock_pid = os.getpid()
+cache = None
+manifest = None
+ts = None
+ts_pid = None
+# (directory, opformat) of the --output shards
+output = None
+numbers = itertools.count()
+# with --coordinator
+client = None
+# builds completed by an earlier run, with --resume
+completed = None
+# with --quarantine
+quarantine = None
+# (i, N) with --shard
+shard = None
+# rpmfile -> [parts left, merged results, opformat, checks] of the packages
+# which were split() across the workers
+parts = {}
+# uncompressed payload bytes of all packages and the part of them which
+# never had to be decompressed, shared with the workers
+payload_bytes = multiprocessing.Value("L", 0)
+skipped_bytes = multiprocessing.Value("L", 0)
 
+# RPMTAG_FILEDIGESTALGO values (pgpHashAlgo in rpm)
+DIGEST_ALGOS = {1: "md5", 2: "sha1", 8: "sha256", 9: "sha384",
+                10: "sha512", 11: "sha224"}
 
-def analyze(rpmfile, show_errors=False, opformat="json"):
-    """Analyse single RPM file"""
-    if not os.path.exists(rpmfile):
-        print >> sys.stderr, "%s doesn't exists!" % rpmfile
-        return
 
-    if not rpmfile.endswith(".rpm"):
-        # print >> sys.stderr, "skipping %s" % os.path.basename(rpmfile)
-        return
+def header_files(h):
+    """
+    Return (name, mode, size, digest) for every file in the RPM header, in
+    payload order. digest is "<algorithm>:<hex>" or None.
+
+    %ghost files aren't part of the payload and are left out. Only the
+    last link of a set of hard links carries data in the cpio payload, so
+    the other links get a size of 0 just like their payload entries do.
+
+    """
+    names = h['FILENAMES']
+    flags = h[rpm.RPMTAG_FILEFLAGS]
+    modes = [mode & 0xffff for mode in h[rpm.RPMTAG_FILEMODES]]
+    sizes = h[rpm.RPMTAG_LONGFILESIZES] or h[rpm.RPMTAG_FILESIZES]
+    digests = h[rpm.RPMTAG_FILEDIGESTS] or [None] * len(names)
+    algo = DIGEST_ALGOS.get(h[rpm.RPMTAG_FILEDIGESTALGO] or 1)
+    links = list(zip(h[rpm.RPMTAG_FILEDEVICES], h[rpm.RPMTAG_FILEINODES]))
 
+    last_link = {}
+    for i, mode in enumerate(modes):
+        if stat.S_ISREG(mode) and not flags[i] & rpm.RPMFILE_GHOST:
+            last_link[links[i]] = i
+
+    files = []
+    for i, name in enumerate(names):
+        if flags[i] & rpm.RPMFILE_GHOST:
+            continue
+        size = sizes[i]
+        if stat.S_ISREG(modes[i]) and last_link[links[i]] != i:
+            size = 0
+        digest = None
+        if algo and digests[i]:
+            digest = "%s:%s" % (algo, digests[i])
+        files.append((name, modes[i], size, digest))
+    return files
+
+
+def count(counter, n):
+    with counter.get_lock():
+        counter.value += n
+
+
+def report(output=sys.stderr):
+    total, skipped = payload_bytes.value, skipped_bytes.value
+    print("[+] payload: %.1f MiB of %.1f MiB skipped (%.1f%%)" %
+          (skipped / 1048576.0, total / 1048576.0,
+           100.0 * skipped / total if total else 0.0), file=output)
+
+
+def transaction_set():
+    """The transaction set of this process, for reading headers"""
+    global ts, ts_pid
+    # like sqlite connections, don't share it with forked workers
+    if ts is None or ts_pid != os.getpid():
+        ts = rpm.TransactionSet()
+        ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+        ts_pid = os.getpid()
+    return ts
+
+
+def process_lock():
+    """The lock of this process around the output and the split parts"""
+    global lock, lock_pid
+    # a worker forked while a thread of the parent held the lock would
+    # never see it released
+    if lock_pid != os.getpid():
+        lock = threading.Lock()
+        lock_pid = os.getpid()
+    return lock
+
+
+def open_package(rpmfile):
+    """
+    Open rpmfile and read its lead, signature and header, signatures
+    aren't checked. Returns the file, positioned at the start of the
+    compressed payload, and the header.
+
+    """
+    f = open(rpmfile, "rb")
+    try:
+        # rpm reads from the descriptor itself, which leaves its offset
+        # right behind the header
+        return f, transaction_set().hdrFromFdno(f.fileno())
+    except Exception:
+        f.close()
+        raise
+
+
+def plan(h, files, classified=False):
+    """
+    Names of the members with data (see header_files()) which have to be
+    read from the payload, going by the file classes in the header h:
+    regular files classified as ELF, or not classified at all. Without
+    file classes in the header every regular file has to be read.
+
+    With classified, only the members the header classifies as ELF are
+    returned (none without file classes).
+
+    """
+    candidates = set(name for name, mode, size, _ in files
+                     if size and stat.S_ISREG(mode))
+    classes = h[rpm.RPMTAG_FILECLASS]
+    classdict = h[rpm.RPMTAG_CLASSDICT]
+    if not classes or not classdict:
+        return set() if classified else candidates
+    elf = set()
+    for name, index in zip(h['FILENAMES'], classes):
+        description = classdict[index]
+        if description.startswith("ELF") or \
+                (not description and not classified):
+            elf.add(name)
+    return candidates & elf
+
+
+def check(contents, checks=None, key=None):
+    """
+    Run checksec on contents (an ELF member), returns the CheckResult or
+    the exception. In a pipeline decompression worker, hand it to the
+    analysis workers instead and return a function which waits for the
+    result.
+
+    """
+    if pipeline.stage is not None:
+        return partial(pipeline.stage.result,
+                       pipeline.stage.submit(contents, checks, key))
     try:
-        a = libarchive.Archive(rpmfile)
+        if cache is not None:
+            return cache.process(contents, checks, key=key)
+        return check_image(BytesIO(contents), checks=checks)
+    except (ELFError, IOError) as exc:
+        return exc
+
+
+def split(h, files, count=None, size=None, most=None):
+    """
+    Split the planned members (see plan()) of a package with more than
+    count of them, or more than size bytes of them, into contiguous groups
+    in payload order of about count members or size bytes each. Returns
+    [(bytes, [name, ...]), ...], or None for packages which stay whole.
+
+    Every part decompresses the payload from its start up to its last
+    member, so a package split into n parts is decompressed about
+    (n + 1) / 2 times over. With most, there are no more than most parts,
+    of about the same size.
+
+    """
+    planned = plan(h, files)
+    members = [(name, msize) for name, _, msize, _ in files
+               if name in planned]
+    if not ((count and len(members) > count) or
+            (size and sum(msize for _, msize in members) > size)):
+        return None
+    groups = []
+    group, group_bytes = [], 0
+    for name, msize in members:
+        group.append(name)
+        group_bytes += msize
+        if (count and len(group) >= count) or (size and group_bytes >= size):
+            groups.append((group_bytes, group))
+            group, group_bytes = [], 0
+    if group:
+        groups.append((group_bytes, group))
+    if most and len(groups) > most:
+        return regroup(members, most)
+    return groups
+
+
+def regroup(members, most):
+    """Split members ([(name, bytes), ...]) into at most most contiguous
+    groups of about the same size, like split() does"""
+    total = sum(msize for _, msize in members)
+    groups = []
+    group, group_bytes, done = [], 0, 0
+    for name, msize in members:
+        group.append(name)
+        group_bytes += msize
+        done += msize
+        if done * most >= total * (len(groups) + 1):
+            groups.append((group_bytes, group))
+            group, group_bytes = [], 0
+    if group:
+        groups.append((group_bytes, group))
+    return groups
+
+
+def analyze_members(rpmfile, members, checks=None):
+    """
+    Analyse only the given ELF members of rpmfile, one part of a package
+    which was split(). Returns (rpmfile, {name: CheckResult or NOT_ELF}),
+    members which couldn't be read are left out.
+
+    """
+    results = {}
+    try:
+        f, h = open_package(rpmfile)
     except Exception as exc:
-        print >> sys.stderr, rpmfile, str(exc)
-        return
+        print(rpmfile, str(exc), file=sys.stderr)
+        return rpmfile, results
 
     try:
-        ts = rpm.TransactionSet()
-        ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
-        fd = os.open(rpmfile, os.O_RDONLY)
-        h = ts.hdrFromFdno(fd)
-        os.close(fd)
+        keys = {}
+        if cache is not None:
+            for name, _, _, digest in header_files(h):
+                if digest and name in members:
+                    keys[name] = cache.key(digest, checks)
+                    verdict = cache.get(keys[name])
+                    if verdict is not None:
+                        results[name] = verdict
+        wanted = set(members) - set(results)
+        pending = {}
+        if wanted:
+            a = libarchive.Archive(f)
+            for entry in a:
+                name = entry.pathname.lstrip(".")
+                if name in wanted:
+                    wanted.discard(name)
+                    contents = a.read(4)
+                    if contents == ELFMAG:
+                        contents += a.read(entry.size - 4)
+                        pending[name] = check(contents, checks, keys.get(name))
+                    else:
+                        results[name] = NOT_ELF
+                if not wanted:
+                    break
+            a.close()
     except Exception as exc:
-        print >> sys.stderr, rpmfile, str(exc)
+        print(rpmfile, str(exc), file=sys.stderr)
+    finally:
+        f.close()
+
+    for name, out in pending.items():
+        try:
+            if callable(out):
+                out = out()
+        except ELFError as exc:
+            out = exc
+        results[name] = NOT_ELF if isinstance(out, Exception) else out
+    return rpmfile, results
+
+
+def read_header(rpmfile):
+    """Read the header of rpmfile"""
+    f, h = open_package(rpmfile)
+    f.close()
+    return h
+
+
+def analyze(rpmfile, show_errors=False, opformat="json", checks=None,
+            opened=None, results=None):
+    """Analyse single RPM file, running only the given checks (all of them
+    by default) on its ELF files. opened is the (file, header) pair from
+    open_package() if rpmfile has been opened already. results are the
+    results of its ELF files if they were analysed elsewhere already
+    (see analyze_members())."""
+    if not os.path.exists(rpmfile):
+        print("%s doesn't exists!" % rpmfile, file=sys.stderr)
+        return
+
+    if not rpmfile.endswith(".rpm"):
+        # print("skipping %s" % os.path.basename(rpmfile), file=sys.stderr)
         return
 
+    if opened is None:
+        try:
+            opened = open_package(rpmfile)
+        except Exception as exc:
+            print(rpmfile, str(exc), file=sys.stderr)
+            return
+
+    f, h = opened
+    try:
+        return analyze_package(rpmfile, f, h, show_errors, opformat, checks,
+                               results)
+    finally:
+        f.close()
+
+
+def analyze_package(rpmfile, f, h, show_errors, opformat, checks,
+                    results=None):
+    """
+    analyze() for the package in the open file f, with header h, the
+    payload is read from f's current offset.
+
+    """
     # create lookup dictionary
     # print dir(h)
     # print dir(rpm)
@@ -79,7 +380,7 @@ def analyze(rpmfile, show_errors=False, opformat="json"):
             filecaps.append([names[i], cap])
 
     pols = []
-    lines = ""
+    lines = []
     output = {}
     output["package"] = package
     output["group"] = group
@@ -95,113 +396,193 @@ def analyze(rpmfile, show_errors=False, opformat="json"):
     if filecaps:
         output["caps"] = True
 
-    flag = False
+    # work plan: only the members which may be ELF files get read, and
+    # every one of them is looked up in the result cache by the digest the
+    # header already carries for it, before decompressing anything
+    files = header_files(h)
+    planned = plan(h, files)
+    keys = {}
+    known = {}
+    if results is not None:
+        # members without a result couldn't be read
+        planned &= set(results)
+        known = results
+    elif checks is not None and not checks:
+        # there is nothing to run on them, the ELF members are listed going
+        # by the header alone
+        planned = plan(h, files, classified=True)
+        known = dict((name, CheckResult()) for name in planned)
+    elif cache is not None:
+        for name, mode, size, digest in files:
+            if not digest or name not in planned:
+                continue
+            keys[name] = cache.key(digest, checks)
+            verdict = cache.get(keys[name])
+            if verdict is not None:
+                known[name] = verdict
+
+    # (filename, mode, size, directory, setxid, result) of every member
+    handled = []
 
-    for entry in a:
+    def member(pathname, mode, size, read):
         directory = False
-        size = entry.size
         # polkit checks, "startswith" is better but ...
-        if "/etc/polkit" in entry.pathname or \
-           "/usr/share/PolicyKit" in entry.pathname or \
-           "/usr/share/polkit-1" in entry.pathname:
-            pols.append(entry.pathname)
+        if "/etc/polkit" in pathname or \
+           "/usr/share/PolicyKit" in pathname or \
+           "/usr/share/polkit-1" in pathname:
+            pols.append(pathname)
             output["polkit"] = True
 
         # check if package is a daemon
-        if "/etc/rc.d/init.d" in entry.pathname or \
-           "/lib/systemd" in entry.pathname:
+        if "/etc/rc.d/init.d" in pathname or \
+           "/lib/systemd" in pathname:
             output["daemon"] = True
 
         # skip 0 byte files only
         # NOTE: size can be 0 due to compression also!
-        if size == 0 and not stat.S_ISDIR(entry.mode):
-            continue
+        if size == 0 and not stat.S_ISDIR(mode):
+            return
 
         # we are only interested in particular kind of directories
-        if stat.S_ISDIR(entry.mode):
-            if not ((entry.mode & stat.S_ISUID) or
-                    (stat.S_ISGID & entry.mode)):
-                continue
+        if stat.S_ISDIR(mode):
+            if not ((mode & stat.S_ISUID) or
+                    (stat.S_ISGID & mode)):
+                return
             else:
-                flag = True
                 directory = True
+        elif not stat.S_ISREG(mode):
+            # symlinks, devices, ... can't be ELF files
+            return
 
         # check for executable flag
-        # if not (entry.mode & 0111):
-        #    continue
+        # if not (mode & 0111):
+        #    return
 
         # always report setxid files
-        if ((entry.mode & stat.S_ISUID) or (stat.S_ISGID & entry.mode)):
-            flag = True
+        flag = bool((mode & stat.S_ISUID) or (stat.S_ISGID & mode))
 
         # skip library files
-        filename = entry.pathname.lstrip(".")
+        filename = pathname.lstrip(".")
         # if not flag and (("lib" in filename and ".so" in filename) or \
         #   filename.endswith(".so")):
-        #   continue
-
-        try:
-            contents = a.read(size)
-        except Exception:
-            continue
+        #   return
 
         # invoke checksec only on files
+        out = None
+        if not directory:
+            out = known.get(filename)
+            if filename not in planned:
+                out = NOT_ELF
+            if out is None:
+                # peek at the magic first, the rest of non-ELF members is
+                # skipped by libarchive without being copied out
+                try:
+                    contents = read(4)
+                    if contents == ELFMAG:
+                        contents += read(size - 4)
+                    else:
+                        out = NOT_ELF
+                        if filename in keys:
+                            # keeps the header-only path open next time
+                            cache.put(keys[filename], NOT_ELF)
+                except Exception:
+                    return
+            if out is None:
+                out = check(contents, checks, keys.get(filename))
+        handled.append((filename, mode, size, directory, flag, out))
+
+    def finish(filename, mode, size, directory, flag, out):
         returncode = -1
         if not directory:
             try:
-                fh = cStringIO(contents)
-                elf = Elf(fh)
+                if out is NOT_ELF:
+                    raise ELFError("Not an ELF binary")
+                elif isinstance(out, Exception):
+                    raise out
+                elif callable(out):
+                    out = out()
                 if opformat == "json":
-                    out = process_file(elf, deps=True)
                     # polkit check 2
-                    if "polkit" in out:
+                    if "polkit" in getattr(out, "DEPS", ""):
                         output["polkit"] = True
-                else:
-                    out = process_file(elf)
                 dataline = "%s,%s,%s,mode=%s,%s" % (package,
                                                     os.path.basename(rpmfile),
-                                                    filename, oct(entry.mode),
+                                                    filename, oct(mode),
                                                     out)
                 returncode = 0
             except ELFError as exc:
                 if show_errors:
-                    print >> sys.stderr, "%s,%s,Not an ELF binary" % \
-                        (filename, str(exc))
-                continue
+                    print("%s,%s,Not an ELF binary" %
+                          (filename, str(exc)), file=sys.stderr)
+                return
             except IOError as exc:
                 if show_errors:
-                    print >> sys.stderr, "%s,%s,Not an ELF binary" % \
-                        (filename, str(exc))
-                continue
+                    print("%s,%s,Not an ELF binary" %
+                          (filename, str(exc)), file=sys.stderr)
+                return
         if flag or returncode == 0:
             # populate fileinfo object
             fileinfo = {}
             fileinfo["name"] = filename
-            fileinfo["size"] = entry.size
-            fileinfo["mode"] = entry.mode
+            fileinfo["size"] = size
+            fileinfo["mode"] = mode
             fileinfo["user"], fileinfo["group"] = lookup[filename][0]
             if directory:
                 fileinfo["directory"] = directory
             output["files"].append(fileinfo)
 
         if returncode == 0 and opformat == "csv":
-            lines = lines + dataline + "\n"
+            lines.append(dataline)
         else:
-            # print >> sys.stderr, dataline
+            # print(dataline, file=sys.stderr)
             pass
         if returncode == 0 and opformat == "json":
-            try:
-                for kvp in out.split(","):
-                    key, value = kvp.split("=")
-                    fileinfo[key] = value
-            except Exception:
-                pass
-    a.close()
+            fileinfo.update(out.as_dict())
+
+    # members which don't have to come from the payload
+    rest = files
+    wanted = set(planned) - set(known)
+    if wanted:
+        try:
+            # the payload follows the header, so libarchive gets to read
+            # it from the same descriptor without the rpm container
+            a = libarchive.Archive(f)
+        except Exception as exc:
+            print(rpmfile, str(exc), file=sys.stderr)
+            return
+
+        seen = set()
+        for entry in a:
+            member(entry.pathname, entry.mode, entry.size, a.read)
+            name = entry.pathname.lstrip(".")
+            seen.add(name)
+            wanted.discard(name)
+            if not wanted:
+                # every planned member is handled, don't decompress the
+                # rest of the payload
+                break
+        a.close()
+        rest = [info for info in files if info[0] not in seen]
+
+    # no member needs to be read (there is no ELF file at all or every one
+    # is in the cache already), the header has everything else
+    for name, mode, size, _ in rest:
+        member("." + name, mode, size, None)
+    count(payload_bytes, sum(size for _, _, size, _ in files))
+    if results is not None:
+        # the parts of a split package only decompressed its ELF members
+        rest = [entry for entry in files if entry[0] not in results]
+    count(skipped_bytes, sum(size for _, _, size, _ in rest))
+
+    # results come in here, in payload order, once all the members are
+    # handed out (they may still be analysed elsewhere at this point)
+    for args in handled:
+        finish(*args)
 
     if opformat == "json":
         return json.dumps(output)
     else:
-        return lines.rstrip()
+        return "\n".join(lines)
 
 
 def profile_main():
@@ -217,70 +598,498 @@ def profile_main():
     p.sort_stats('cumulative').print_stats(200)
 
 
-def output_callback(result):
-    with lock:
-        if result:
-            print(result)
+def rescan(rpmfile, size, mtime, opformat, checks):
+    """
+    analyze() for incremental scans, also returning what goes into the
+    manifest about rpmfile.
+
+    """
+    try:
+        opened = open_package(rpmfile)
+    except Exception as exc:
+        print(rpmfile, str(exc), file=sys.stderr)
+        return
+    h = opened[1]
+    result = analyze(rpmfile, False, opformat, checks, opened)
+    return rpmfile, size, mtime, h[rpm.RPMTAG_SHA1HEADER], result
+
+
+def sha1header(rpmfile):
+    try:
+        return read_header(rpmfile)[rpm.RPMTAG_SHA1HEADER]
+    except Exception:
+        return None
+
+
+def payload_size(rpmfile):
+    """
+    Uncompressed payload size of rpmfile according to its header, which
+    tracks the analysis time more closely than the compressed file size.
+
+    """
+    try:
+        h = read_header(rpmfile)
+    except Exception:
+        return file_size(rpmfile)
+    return archive_size(rpmfile, h)
+
+
+def archive_size(rpmfile, h):
+    """payload_size() of rpmfile with header h"""
+    return h[rpm.RPMTAG_LONGARCHIVESIZE] or h[rpm.RPMTAG_ARCHIVESIZE] or \
+        file_size(rpmfile)
+
+
+def changed(path, size, opformat, checks):
+    """
+    Generate rescan() jobs for the packages below path which aren't in the
+    manifest yet or changed since, outputting the earlier results of the
+    unchanged ones right away.
+
+    """
+    for rpmfile in walk(path, wanted):
+        try:
+            st = os.stat(rpmfile)
+        except OSError as exc:
+            print(rpmfile, str(exc), file=sys.stderr)
+            continue
+        result = manifest.lookup(os.path.basename(rpmfile), st.st_size,
+                                 st.st_mtime, partial(sha1header, rpmfile))
+        if result is not None:
+            output_callback(result, build=os.path.basename(rpmfile))
+            continue
+        yield size(rpmfile), (rpmfile, st.st_size, st.st_mtime, opformat,
+                              checks)
+
+
+def wanted(rpmfile):
+    if not scanned_rpm(rpmfile):
+        return False
+    if completed and os.path.basename(rpmfile) in completed:
+        return False
+    return shard is None or in_shard(source(rpmfile, transaction_set()),
+                                     shard)
+
+
+def output_callback(result, seq=None, build=None):
+    """
+    Output the record of a package, to the standard output or with
+    --output to the shard of this process, numbered seq (or the next
+    number). With --output, build is journaled as completed unless it
+    failed (result is None).
+
+    """
+    with process_lock():
+        if output is None:
+            if result:
+                print(result)
+        elif result or (result is not None and build is not None):
+            # a record cut in half by --time-limit would throw the shard
+            # out of step with its index
+            finishing()
+            writer(*output).write(next(numbers) if seq is None else seq,
+                                  result, build)
+
+
+def rescan_callback(ret):
+    if ret is None:
+        return
+    rpmfile, size, mtime, sha1, result = ret
+    if result is not None:
+        manifest.store(os.path.basename(rpmfile), size, mtime, sha1, result)
+    if output is None:
+        output_callback(result)
+
+
+def analyze_sharded(seq, *args):
+    """analyze() writing the record to the shard of the worker"""
+    output_callback(analyze(*args), seq, os.path.basename(args[0]))
+
+
+def rescan_sharded(seq, *args):
+    """rescan() writing the record to the shard of the worker, the parent
+    still gets it for the manifest"""
+    ret = rescan(*args)
+    if ret is not None:
+        output_callback(ret[-1], seq, os.path.basename(ret[0]))
+    return ret
+
+
+def dispatch(func, *args):
+    """Run func(*args), for job lists mixing different functions"""
+    return func(*args)
+
+
+def split_jobs(path, size, opformat, checks, count, limit, most):
+    """
+    Generate dispatch() jobs for the packages below path, packages with
+    many ELF members (see split()) become one analyze_members() job per
+    group of members, sized by their uncompressed bytes.
+
+    """
+    for rpmfile in walk(path, wanted):
+        try:
+            h = read_header(rpmfile)
+            groups = None
+            if checks is None or checks:
+                groups = split(h, header_files(h), count, limit, most)
+        except Exception:
+            # analyze() reports it
+            h, groups = None, None
+        if groups is None:
+            weight = size(rpmfile, h) if h is not None else 0
+            yield weight, (analyze_named, rpmfile, rpmfile, False, opformat,
+                           checks)
+            continue
+        with process_lock():
+            parts[rpmfile] = [len(groups), {}, opformat, checks]
+        for nbytes, members in groups:
+            yield nbytes, (analyze_members, rpmfile, members, checks)
+
+
+def split_callback(ret):
+    """
+    Output the records of whole packages, and collect the results of split
+    packages until all of their parts are in (or were stopped, see
+    quarantined()). The package record is then assembled from them and
+    its header in the parent.
+
+    """
+    rpmfile, results = ret
+    if not isinstance(results, dict):
+        output_callback(results, build=os.path.basename(rpmfile))
+        return
+    with process_lock():
+        state = parts[rpmfile]
+        state[0] -= 1
+        state[1].update(results)
+        if state[0]:
+            return
+        del parts[rpmfile]
+    _, merged, opformat, checks = state
+    output_callback(analyze(rpmfile, False, opformat, checks,
+                            results=merged), build=os.path.basename(rpmfile))
+
+
+def unchecked(reason, checks=None):
+    """CheckResult of an ELF member whose analysis was stopped"""
+    result = CheckResult()
+    # the verdicts end up in CSV lines as well
+    verdict = "Unchecked$%s" % reason.replace(",", ";")
+    for name in checks or CHECK_NAMES:
+        setattr(result, name, verdict)
+    return result
+
+
+def analyze_named(name, *args):
+    """analyze() returning name (the path of the package in the listing
+    of the coordinator, ...) as well"""
+    try:
+        return name, analyze(*args)
+    except Exception:
+        # a package served by the coordinator still has to be reported,
+        # or it would be served again
+        traceback.print_exc()
+        return name, None
+
+
+def leased_callback(ret):
+    """Report the package as done, and output its record if this worker
+    is the one which finished it first"""
+    lease, result = ret
+    if client.done(lease):
+        output_callback(result, build=os.path.basename(lease))
+
+
+def quarantined(func, args, reason):
+    """
+    Record the package of a job which went over its budget (or whose
+    worker died) in the --quarantine file, to be retried separately.
+
+    """
+    rpmfile = [arg for arg in args
+               if isinstance(arg, str) and arg.endswith(".rpm")][-1]
+    if client is not None and func is analyze_named:
+        # don't have it served again
+        client.done(args[0])
+    if func is dispatch and args[0] is analyze_members:
+        # the other parts of the package still make up its record, with
+        # these members marked as Unchecked
+        rpmfile, members, checks = args[1:]
+        split_callback((rpmfile, dict.fromkeys(members,
+                                               unchecked(reason, checks))))
+    if quarantine is None:
+        return
+    with process_lock():
+        with open(quarantine, "a") as f:
+            f.write("%s\t%s\n" % (rpmfile, reason))
 
 
 def main():
-    if len(sys.argv) < 2:
-        sys.stderr.write("Usage: %s <path to RPM files> "
-                    "[output format (csv / json)] [existing JSON file]\n"
-                    % sys.argv[0])
-        sys.exit(-1)
+    parser = argparse.ArgumentParser(description="Fast RPM analysis tool")
+    parser.add_argument("path", help="path to RPM files")
+    parser.add_argument("opformat", nargs="?", default="csv",
+                        help="output format (csv / json)")
+    parser.add_argument("existing", nargs="?",
+                        help="existing JSON file, an existing manifest "
+                        "(see --manifest) is used as such")
+    parser.add_argument("--manifest", metavar="PATH",
+                        help="manifest of earlier scans (sqlite database, "
+                        "created if missing), unchanged packages are "
+                        "skipped and their earlier results are output")
+    parser.add_argument("--checks", type=checks_argument, default=None,
+                        help="comma separated list of checks to run on "
+                        "ELF files (default: all). JSON output always runs "
+                        "DEPS, the polkit flag of packages needs it. "
+                        "Without any check, ELF files are listed by the "
+                        "file classes of the header and never read")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="cache ELF results by content in this sqlite "
+                        "database")
+    parser.add_argument("--cache-size", type=int, default=256,
+                        metavar="MB", help="maximum size of the result "
+                        "cache (default: 256)")
+    parser.add_argument("-j", "--jobs", type=int, default=default_workers(),
+                        help="number of worker processes (default: number "
+                        "of CPUs)")
+    parser.add_argument("--window", type=int, default=None,
+                        help="maximum number of packages queued or being "
+                        "analysed at once (default: twice the workers)")
+    parser.add_argument("--order", choices=("size", "payload", "walk"),
+                        default="walk", help="dispatch packages largest "
+                        "first by file size or by header payload size, or "
+                        "in directory walk order (default: walk)")
+    parser.add_argument("--lookahead", type=int, default=256, metavar="N",
+                        help="with --order size or payload, dispatch the "
+                        "largest of the next N packages first, 0 to sort "
+                        "the whole repository before starting (default: "
+                        "256)")
+    parser.add_argument("--reserve", type=int, default=0, metavar="N",
+                        help="keep N workers for the smallest packages, "
+                        "requires --order size or payload, the whole "
+                        "repository is sorted first then (default: 0)")
+    parser.add_argument("--adaptive", type=int, default=None, metavar="MIN",
+                        help="adapt the number of packages analysed at once "
+                        "between MIN and --jobs to the CPU and I/O wait "
+                        "load (replaces --window)")
+    parser.add_argument("--output", metavar="DIR",
+                        help="have every worker write its records to its "
+                        "own compressed shard in DIR (use one directory "
+                        "per scan) instead of the standard output")
+    parser.add_argument("--merge", metavar="FILE",
+                        help="with --output, merge the shards into FILE "
+                        "(compressed if it ends with .gz) in order")
+    parser.add_argument("--pipeline", type=int, default=0, metavar="N",
+                        help="split the work into a decompression stage "
+                        "(--jobs workers) and an ELF analysis stage with N "
+                        "workers, connected through shared memory")
+    parser.add_argument("--queue", type=int, default=None, metavar="N",
+                        help="with --pipeline, maximum number of ELF files "
+                        "waiting for the analysis stage (default: twice "
+                        "the analysis workers)")
+    parser.add_argument("--split", type=int, default=None, metavar="N",
+                        help="spread the ELF files of packages with more "
+                        "than N of them across the workers, in groups of "
+                        "N files")
+    parser.add_argument("--split-size", type=int, default=None,
+                        metavar="MB", help="spread the ELF files of "
+                        "packages with more than MB megabytes of them "
+                        "across the workers, in groups of MB megabytes")
+    parser.add_argument("--split-parts", type=int, default=4, metavar="N",
+                        help="with --split or --split-size, split a "
+                        "package into N groups at most (default: 4). Each "
+                        "group decompresses the payload up to its last "
+                        "file, so a package costs about (N + 1) / 2 times "
+                        "its decompression")
+    parser.add_argument("--shard", type=shard_argument, default=None,
+                        metavar="i/N", help="only scan shard i (counting "
+                        "from 0) of N, by a stable hash of the source "
+                        "package name (see shard-merge.py)")
+    parser.add_argument("--coordinator", metavar="ADDRESS",
+                        help="scan the packages served by a coordinator "
+                        "(see coordinator.py) on ADDRESS (host:port or "
+                        "a Unix socket), path is the local mount point of "
+                        "the repository")
+    parser.add_argument("--batch", type=int, default=1, metavar="N",
+                        help="with --coordinator, take N packages at a "
+                        "time (default: 1)")
+    parser.add_argument("--resume", action="store_true",
+                        help="with --output, skip the builds an interrupted "
+                        "scan into the same directory completed and write "
+                        "the rest to new shards")
+    parser.add_argument("--time-limit", type=float, default=None,
+                        metavar="SECONDS", help="stop packages which take "
+                        "longer than this, killing their worker if need "
+                        "be")
+    parser.add_argument("--memory-limit", type=int, default=None,
+                        metavar="MB", help="stop packages whose worker "
+                        "grows beyond this much resident memory, killing "
+                        "it if need be")
+    parser.add_argument("--quarantine", metavar="FILE",
+                        help="append the packages stopped by --time-limit "
+                        "or --memory-limit, or whose worker died, to FILE")
+    parser.add_argument("--max-tasks", type=int, default=None, metavar="N",
+                        help="replace every worker after N packages, to "
+                        "cap leaks")
+    args = parser.parse_args()
+    if args.existing and not args.manifest:
+        if is_manifest(args.existing):
+            args.manifest = args.existing
+        else:
+            # earlier results without the package files they came from
+            # can't be reused, which was never done anyway
+            print("[*] ignoring %s, earlier results are only reused from "
+                  "an existing manifest, --manifest creates one" %
+                  args.existing, file=sys.stderr)
+    if args.manifest and os.path.exists(args.manifest) and \
+            not is_manifest(args.manifest):
+        parser.error("%s isn't a manifest (sqlite database)" % args.manifest)
+    if args.merge and not args.output:
+        parser.error("--merge requires --output")
+    if args.resume and (not args.output or args.coordinator):
+        parser.error("--resume requires --output, and can't be combined "
+                     "with --coordinator")
+    if args.pipeline:
+        if pipeline.shared_memory is None:
+            parser.error("--pipeline needs Python 3.8 or later")
+        if args.reserve or args.adaptive or args.time_limit or \
+                args.memory_limit or args.max_tasks:
+            parser.error("--pipeline can't be combined with --reserve, "
+                         "--adaptive, --time-limit, --memory-limit or "
+                         "--max-tasks")
+    if args.reserve and args.order == "walk":
+        parser.error("--reserve requires --order size or payload")
+    splitting = args.split or args.split_size
+    if args.split_parts < 1:
+        parser.error("--split-parts must be at least 1")
+    if splitting and args.manifest:
+        parser.error("--split and --split-size can't be combined with a "
+                     "manifest")
+    if args.coordinator and (splitting or args.manifest or args.shard or
+                             args.reserve):
+        parser.error("--coordinator can't be combined with --split, "
+                     "--shard, --reserve or a manifest")
 
-    path = sys.argv[1]
+    path = args.path
+    opformat = args.opformat
+    checks = args.checks
+    if opformat == "json" and checks is not None and "DEPS" not in checks:
+        # the dependencies of the ELF files are the second polkit check
+        checks = tuple(checks) + ("DEPS",)
 
-    if (len(sys.argv) > 2):
-        opformat = sys.argv[2]
-    else:
-        opformat = "csv"
-
-    parallel = True
-    # parallel = False
-    if parallel:
-        p = multiprocessing.Pool(5)  # FIXME add autodetection?
-
-    # pruning code to make analysis faster
-    if (len(sys.argv) > 3):
-        with open(sys.argv[3]) as f:
-            for line in f.readlines():
-                line = line.rstrip()
-                try:
-                    build = json.loads(line)
-                    data[build["build"]] = build
-                except Exception as exc:
-                    print(str(exc))
-                    sys.exit(1)
+    global cache
+    if args.cache:
+        # created before the pool is forked, so that the hits and misses
+        # of every worker add up in its shared counters
+        cache = ResultCache(args.cache, args.cache_size * 1024 * 1024)
+
+    global manifest
+    if args.manifest:
+        manifest = Manifest(args.manifest, options(opformat, checks))
+
+    global shard
+    shard = args.shard
+
+    global output, completed, numbers
+    if args.output:
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        output = (args.output, opformat)
+        if args.resume:
+            completed, start = shards.resume(args.output)
+            numbers = itertools.count(start)
+            print("[+] resuming: %d builds completed, segment %d" %
+                  (len(completed), shards.segment), file=sys.stderr)
+        elif shards.shards(args.output):
+            parser.error("%s holds the shards of an earlier scan, use "
+                         "--resume or another directory" % args.output)
 
-    outputmap = {}
     if(os.path.isfile(path)):
         sys.stderr.write("Analyzing %s ...\n" % path)
-        out = analyze(path, opformat=opformat)
+        out = analyze(path, opformat=opformat, checks=checks)
         if out:
             print(out)
     else:
-        for (path, _, files) in os.walk(path):
-            for fname in files:
-                rpmfile = os.path.join(path, fname)
-                if "-debuginfo-" in rpmfile or rpmfile.endswith(".drpm"):
-                    continue
-                #if os.path.basename(rpmfile) in data:
-                    # print >> sys.stderr, "Skipping", rpmfile
-                #    pass
-                if parallel:
-                    outputmap[rpmfile] = p.apply_async(analyze,
-                            (rpmfile, False, opformat),
-                            callback=output_callback)
-                else:
-                    out = analyze(path, opformat=opformat)
-                    if out:
-                        print(out)
-
-    if parallel:
-        p.close()
-        p.join()
+        # the pool blocks while --window jobs are in flight, so memory
+        # stays flat. Largest first keeps giant packages from running
+        # alone at the end of the scan, within --lookahead packages paths
+        # are still streamed lazily.
+        if args.order == "payload":
+            size = payload_size
+        elif args.order == "size":
+            size = file_size
+        else:
+            size = lambda rpmfile: 0
+        if args.coordinator:
+            # the coordinator hands out packages largest first, and only
+            # as fast as the pool takes them
+            global client
+            client = Client(args.coordinator)
+            jobs = ((0, (lease, os.path.join(path, lease), False, opformat,
+                         checks))
+                    for lease in client.paths(args.batch))
+            func, callback = analyze_named, leased_callback
+        elif splitting:
+            # parts are sized by their uncompressed bytes, so whole
+            # packages go by their payload size as well
+            weight = archive_size
+            if args.order == "walk":
+                weight = lambda rpmfile, h: 0
+            limit = args.split_size and args.split_size * 1024 * 1024
+            jobs = split_jobs(path, weight, opformat, checks, args.split,
+                              limit, args.split_parts)
+            func, callback = dispatch, split_callback
+        elif manifest is not None:
+            jobs = changed(path, size, opformat, checks)
+            func, callback = rescan, rescan_callback
+        else:
+            jobs = ((size(rpmfile), (rpmfile, False, opformat, checks))
+                    for rpmfile in walk(path, wanted))
+            func, callback = analyze, output_callback
+        number = None
+        if output is not None and not (splitting or args.coordinator):
+            # workers write their records themselves, numbered in the
+            # order the packages are dispatched in. Split packages are only
+            # complete in the parent, and the coordinator has to accept a
+            # record before it is written, the parent writes them then.
+            func = rescan_sharded if func is rescan else analyze_sharded
+            number = partial(next, numbers)
+        global quarantine
+        quarantine = args.quarantine
+        budget = None
+        if args.time_limit or args.memory_limit or args.quarantine:
+            budget = Budget(args.time_limit, args.memory_limit and
+                            args.memory_limit * 1024 * 1024, quarantined)
+            if output is not None:
+                # a killed worker takes the records it didn't journal yet
+                # with it, and their builds were neither output nor
+                # quarantined, so journal every one before its job is
+                # done
+                shards.JOURNAL_INTERVAL = 1
+        pool = partial(BoundedPool, budget=budget,
+                       maxtasksperchild=args.max_tasks)
+        if args.pipeline:
+            pool = partial(pipeline.Pipeline, analysers=args.pipeline,
+                           cache=cache, queue_size=args.queue)
+        stats = run_jobs(func, jobs, args.jobs, args.window, args.reserve,
+                         callback, largest_first=args.order != "walk" and
+                         client is None, number=number, pool=pool,
+                         adaptive=args.adaptive, lookahead=args.lookahead)
+        stats.report()
+        if client is not None:
+            client.close()
+
+    if output is not None:
+        shards.close()
+        if args.merge:
+            shards.merge_to(args.output, args.merge)
+
+    if manifest is not None:
+        manifest.close()
+        manifest.report()
+    report()
+    if cache is not None:
+        cache.report()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,639 @@
+"""
+Job scheduling helpers shared by the repository scanners.
+
+BoundedPool wraps multiprocessing.Pool so that at most a fixed number of
+jobs are queued or running at any time. Submitting blocks while that window
+is full, which keeps the task queue and the pending results from growing
+with the size of the repository being scanned.
+
+run_jobs() dispatches a list of sized jobs largest-first (LPT scheduling),
+over the whole list or within a bounded lookahead, so that a few giant
+packages don't end up running alone at the end of a scan, optionally
+keeping some workers for the small jobs only.
+
+Controller adapts the number of active workers of a BoundedPool to what
+the scan is bound by, going by the CPU time of the workers and the share
+of idle and I/O wait time of the system.
+
+A Budget limits the wall clock time and the memory (RSS) of every job of a
+BoundedPool. A watchdog thread in each worker interrupts a job which goes
+over budget, and the pool kills and replaces a worker which doesn't stop
+(stuck in C code, ...) or which dies, failing its job. Offending jobs are
+handed to a quarantine callback.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import heapq
+import signal
+import threading
+import traceback
+import multiprocessing
+from functools import partial
+from collections import deque
+
+
+def default_workers():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def walk(path, accept=None):
+    """
+    Lazily generate the files below path (or path itself if it is a file)
+    for which accept(filename) is true.
+
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+    for (dirpath, _, files) in os.walk(path):
+        for fname in files:
+            filename = os.path.join(dirpath, fname)
+            if accept is None or accept(filename):
+                yield filename
+
+
+def file_size(filename):
+    """Size of filename, 0 if it can't be determined"""
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+# the Watchdog of this worker process, if the pool has a Budget
+watchdog = None
+
+# seconds a job may stay over budget before its worker is killed
+BUDGET_GRACE = 10.0
+
+
+class BudgetExceeded(BaseException):
+    """
+    Raised in a job which went over its Budget. Not an Exception, so that
+    the error handling of the job doesn't swallow it.
+
+    """
+
+
+class Budget(object):
+    """
+    Limits for every job of a BoundedPool: seconds of wall clock time and
+    rss bytes of resident memory of its worker (None for no limit).
+    quarantine(func, args, reason) is called in the parent for every job
+    which was stopped, or whose worker died.
+
+    """
+
+    def __init__(self, seconds=None, rss=None, quarantine=None):
+        self.seconds = seconds
+        self.rss = rss
+        self.quarantine = quarantine
+
+    def exceeded(self, elapsed, rss):
+        """Why a job which ran for elapsed seconds in a worker using rss
+        bytes is over budget, None if it isn't"""
+        if self.seconds and elapsed > self.seconds:
+            return "time limit of %gs exceeded" % self.seconds
+        if self.rss and rss > self.rss:
+            return "memory limit of %d MiB exceeded (%d MiB)" % \
+                (self.rss >> 20, rss >> 20)
+        return None
+
+
+class Watchdog(threading.Thread):
+    """
+    Worker side of a Budget: interrupts the job running in this process
+    with BudgetExceeded once it goes over budget, and tells the parent
+    which process runs which job.
+
+    """
+
+    def __init__(self, budget, started):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.budget = budget
+        self.started = started
+        # the signal handler takes it in the main thread too
+        self.lock = threading.RLock()
+        self.job = None
+        self.start_time = None
+        self.reason = None
+        self.interval = min(budget.seconds or 1.0, 1.0) / 2
+        signal.signal(signal.SIGUSR1, self._interrupt)
+
+    def arm(self, job):
+        with self.lock:
+            self.job, self.start_time, self.reason = job, time.time(), None
+        self.started.put((job, os.getpid()))
+
+    def disarm(self):
+        with self.lock:
+            self.job = self.reason = None
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.job is None or self.reason is not None:
+                    continue
+                self.reason = self.budget.exceeded(
+                    time.time() - self.start_time, rss(os.getpid()))
+                if self.reason is None:
+                    continue
+            # the main thread raises it as soon as it runs Python code
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+    def _interrupt(self, signum, frame):
+        with self.lock:
+            reason = self.reason
+        # the job may just have finished
+        if reason is not None and self.job is not None:
+            raise BudgetExceeded(reason)
+
+
+def finishing():
+    """
+    Called by a job of a BoundedPool with a Budget before its last step
+    (writing its record, ...), which isn't interrupted any more then, so
+    that it doesn't get cut in half.
+
+    """
+    if watchdog is not None:
+        watchdog.disarm()
+
+
+def _watch(budget, started):
+    """Pool initializer of BoundedPool workers with a Budget"""
+    global watchdog
+    watchdog = Watchdog(budget, started)
+    watchdog.start()
+
+
+def _run(func, args, job=None):
+    """
+    Pool side of BoundedPool.submit(), exceptions are turned into a result
+    so that the parent always gets a callback and can release the slot.
+    The time spent in func is returned as well.
+
+    """
+    start = time.time()
+    try:
+        if watchdog is not None:
+            watchdog.arm(job)
+        try:
+            ok, value = True, func(*args)
+        finally:
+            if watchdog is not None:
+                watchdog.disarm()
+    except BudgetExceeded as exc:
+        ok, value = False, exc
+    except Exception:
+        ok, value = False, traceback.format_exc()
+    return ok, value, time.time() - start
+
+
+class BoundedPool(object):
+    def __init__(self, processes=None, window=None, budget=None, **kwargs):
+        self.processes = processes or default_workers()
+        self.window = window or 2 * self.processes
+        self.budget = budget
+        self.jobs = 0
+        # job -> [func, args, AsyncResult, pid, start] of jobs in flight
+        self.running = {}
+        # pid -> why the monitor killed it
+        self.killed = {}
+        if budget is not None:
+            # written right away, a worker may die at any time after
+            self.started = multiprocessing.SimpleQueue()
+            kwargs.update(initializer=_watch,
+                          initargs=(budget, self.started))
+        self.pool = multiprocessing.Pool(self.processes, **kwargs)
+        self.inflight = 0
+        self.completed = 0
+        self.slots = threading.Condition()
+        if budget is not None:
+            self.closed = threading.Event()
+            self.monitor = threading.Thread(target=self._monitor)
+            self.monitor.daemon = True
+            self.monitor.start()
+
+    def resize(self, window):
+        """
+        Change the number of jobs allowed in flight. Jobs already running
+        aren't affected, a smaller window just takes effect as they finish.
+
+        """
+        with self.slots:
+            self.window = window
+            self.slots.notify_all()
+
+    def pids(self):
+        """Process ids of the workers"""
+        # multiprocessing.Pool doesn't expose its workers otherwise
+        return [process.pid for process in self.pool._pool]
+
+    def _acquire(self):
+        with self.slots:
+            while self.inflight >= self.window:
+                self.slots.wait()
+            self.inflight += 1
+
+    def _release(self, completed=1):
+        with self.slots:
+            self.inflight -= 1
+            self.completed += completed
+            self.slots.notify()
+
+    def submit(self, func, args=(), callback=None, timer=None):
+        """
+        Run func(*args) in the pool and hand its return value to callback
+        (in the parent's result thread), blocking while the window of
+        in-flight jobs is full. timer is called with the number of seconds
+        the job took.
+
+        """
+        self._acquire()
+        with self.slots:
+            self.jobs += 1
+            job = self.jobs
+            self.running[job] = [func, args, None, None, None]
+
+        def done(ret):
+            ok, value, elapsed = ret
+            with self.slots:
+                # a job whose worker died is only failed once
+                if self.running.pop(job, None) is None:
+                    return
+            try:
+                if timer is not None:
+                    timer(elapsed)
+                if isinstance(value, BudgetExceeded):
+                    self._quarantine(func, args, str(value))
+                elif not ok:
+                    print("[-] %s%s failed:\n%s" %
+                          (func.__name__, args, value), file=sys.stderr)
+                elif callback is not None:
+                    callback(value)
+            finally:
+                self._release()
+
+        try:
+            result = self.pool.apply_async(_run, (func, args, job),
+                                           callback=done)
+        except Exception:
+            with self.slots:
+                self.running.pop(job, None)
+            self._release(0)
+            raise
+        with self.slots:
+            if job in self.running:
+                self.running[job][2] = result
+
+    def _quarantine(self, func, args, reason):
+        print("[-] %s%s: %s, quarantined" % (func.__name__, args, reason),
+              file=sys.stderr)
+        if self.budget.quarantine is not None:
+            self.budget.quarantine(func, args, reason)
+
+    def _monitor(self):
+        """
+        Parent side of the Budget: kill the workers of jobs which stay
+        over budget although their watchdog interrupted them, and fail the
+        jobs of workers which died.
+
+        """
+        while not self.closed.wait(0.5):
+            while not self.started.empty():
+                job, pid = self.started.get()
+                with self.slots:
+                    if job in self.running:
+                        self.running[job][3:] = [pid, time.time()]
+            alive = set(process.pid for process in self.pool._pool
+                        if process.exitcode is None)
+            with self.slots:
+                running = [(job, entry) for job, entry in self.running.items()
+                           if entry[3] is not None]
+            for job, (func, args, result, pid, start) in running:
+                if pid not in alive:
+                    self._lost(job, self.killed.pop(pid, "worker %d died" %
+                                                    pid))
+                    continue
+                reason = self.budget.exceeded(
+                    time.time() - start - BUDGET_GRACE,
+                    rss(pid) if self.budget.rss and
+                    time.time() - start > BUDGET_GRACE else 0)
+                if reason is not None:
+                    print("[-] %s%s: %s, killing worker %d" %
+                          (func.__name__, args, reason, pid),
+                          file=sys.stderr)
+                    self.killed[pid] = "%s, worker killed" % reason
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+
+    def _lost(self, job, reason):
+        """Fail job, its worker is gone and won't ever return a result"""
+        with self.slots:
+            entry = self.running.pop(job, None)
+        if entry is None:
+            return
+        func, args, result, _, start = entry
+        try:
+            # multiprocessing.Pool would wait for it forever
+            del self.pool._cache[result._job]
+        except (KeyError, AttributeError):
+            pass
+        self._quarantine(func, args, reason)
+        self._release()
+
+    def close(self):
+        self.pool.close()
+
+    def join(self):
+        self.pool.join()
+        if self.budget is not None:
+            self.closed.set()
+            self.monitor.join()
+
+    def terminate(self):
+        self.pool.terminate()
+
+
+# /proc/<pid>/stat counts in clock ticks
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+# and /proc/<pid>/statm in pages
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# share of all CPU time spent in I/O wait above which we back off
+IOWAIT_HIGH = 0.25
+
+
+def system_times():
+    """(busy, iowait, idle) clock ticks of all CPUs, from /proc/stat"""
+    with open("/proc/stat") as f:
+        # user nice system idle iowait irq softirq steal ...
+        fields = [int(value) for value in f.readline().split()[1:9]]
+    fields += [0] * (8 - len(fields))
+    return sum(fields) - fields[3] - fields[4], fields[4], fields[3]
+
+
+def process_time(pid):
+    """CPU seconds (user and system) used by pid, 0 if it is gone"""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            # the command name may contain spaces and parentheses
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return 0.0
+    # utime and stime are fields 14 and 15 of stat(5)
+    return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+
+
+def rss(pid):
+    """Resident memory of pid in bytes, 0 if it is gone"""
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+
+
+class Controller(threading.Thread):
+    """
+    Grow or shrink the number of jobs a BoundedPool runs at once, between
+    minimum and the pool size, every interval seconds:
+
+    - busy workers (in CPU time) with CPUs to spare get one more, and so
+      do idle workers while the system isn't waiting for I/O, as they
+      are waiting on something else (a slow network file system, ...)
+    - high I/O wait or saturated CPUs cost a worker
+    - a step which didn't pay off in completed jobs per second is undone,
+      and the count is left alone for a while
+
+    Decisions are logged to output.
+
+    """
+
+    def __init__(self, pool, minimum=1, interval=5.0, output=sys.stderr):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.maximum = pool.processes
+        self.minimum = min(max(minimum, 1), self.maximum)
+        self.interval = interval
+        self.output = output
+        self.active = min(max(default_workers(), self.minimum), self.maximum)
+        self.last_step = 0
+        self.last_rate = None
+        self.hold = 0
+        self.stopped = threading.Event()
+        pool.resize(self.active)
+
+    def run(self):
+        last = self.sample()
+        while not self.stopped.wait(self.interval):
+            now = self.sample()
+            self.step(last, now)
+            last = now
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def sample(self):
+        return (time.time(), system_times(), self.pool.completed,
+                dict((pid, process_time(pid)) for pid in self.pool.pids()))
+
+    def step(self, last, now):
+        elapsed = now[0] - last[0]
+        busy, iowait, idle = [b - a for a, b in zip(last[1], now[1])]
+        total = float(busy + iowait + idle) or 1.0
+        rate = (now[2] - last[2]) / elapsed
+        used = sum(seconds - last[3].get(pid, 0.0)
+                   for pid, seconds in now[3].items())
+        usage = used / (elapsed * self.active)
+        # at least half a CPU idle
+        spare = idle / total > 0.5 / default_workers()
+
+        step, reason = 0, None
+        if self.hold:
+            self.hold -= 1
+        elif self.last_step and self.last_rate is not None and \
+                rate < self.last_rate * 1.05:
+            step, reason = -self.last_step, "last step didn't pay off"
+            self.hold = 3
+        elif iowait / total > IOWAIT_HIGH:
+            step, reason = -1, "high I/O wait"
+        elif idle / total < 0.05 and usage < 0.7:
+            step, reason = -1, "CPUs saturated"
+        elif spare and usage > 0.8:
+            step, reason = 1, "workers CPU bound"
+        elif spare and usage < 0.5:
+            step, reason = 1, "workers waiting"
+
+        target = min(max(self.active + step, self.minimum), self.maximum)
+        applied = target - self.active
+        if applied:
+            print("[*] workers %d -> %d: %s (worker CPU %d%%, idle %d%%, "
+                  "I/O wait %d%%, %.1f jobs/s)" %
+                  (self.active, target, reason, 100 * usage,
+                   100 * idle / total, 100 * iowait / total, rate),
+                  file=self.output)
+            self.active = target
+            self.pool.resize(target)
+        # undoing a step is final for the hold period
+        self.last_step = 0 if self.hold else applied
+        self.last_rate = rate
+
+
+def makespan(durations, workers):
+    """
+    Makespan of greedy list scheduling, every job (in the given order)
+    goes to the worker which becomes idle first.
+
+    """
+    idle = [0.0] * max(workers, 1)
+    for duration in durations:
+        heapq.heapreplace(idle, idle[0] + duration)
+    return max(idle)
+
+
+class Makespan(object):
+    """Job durations, dispatch order and wall clock time of a run_jobs()
+    run"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.durations = {}
+        self.order = []
+        self.elapsed = 0.0
+
+    def dispatched(self, seq):
+        self.order.append(seq)
+
+    def record(self, seq, duration):
+        self.durations[seq] = duration
+
+    def report(self, output=sys.stderr):
+        """
+        Report the measured makespan, and the makespans of the walk order,
+        of the largest-first order and of the order the jobs were actually
+        dispatched in, all three estimated from the measured job durations
+        (without the overhead of the pool). The gain is the one of the
+        dispatch order over the walk order.
+
+        """
+        durations = [self.durations[seq] for seq in sorted(self.durations)]
+        walk_order = makespan(durations, self.workers)
+        lpt_order = makespan(sorted(durations, reverse=True), self.workers)
+        dispatch_order = makespan([self.durations[seq] for seq in self.order
+                                   if seq in self.durations], self.workers)
+        gain = walk_order - dispatch_order
+        print("[+] makespan: %.1fs for %d jobs on %d workers, estimated: "
+              "walk order ~%.1fs, largest first ~%.1fs, dispatch order "
+              "~%.1fs, gain %.1fs (%.1f%%)" %
+              (self.elapsed, len(durations), self.workers, walk_order,
+               lpt_order, dispatch_order, gain, 100.0 * gain / walk_order
+               if walk_order else 0.0), file=output)
+
+
+def run_jobs(func, jobs, processes=None, window=None, reserve=0,
+             callback=None, largest_first=True, number=None,
+             pool=BoundedPool, adaptive=None, lookahead=None):
+    """
+    Run func(*args) for every (size, args) in jobs, handing the results to
+    callback, and return a Makespan for the run. With number, jobs run as
+    func(number(), *args) instead, number() being called as they are
+    dispatched. pool(processes, window) creates the pools the jobs run in.
+    With adaptive, a Controller runs between adaptive and processes jobs
+    at once (window is ignored then).
+
+    With largest_first the jobs are dispatched in decreasing order of size,
+    otherwise they are dispatched as they come. With a lookahead of N,
+    the largest of the next N jobs goes first, so jobs may still be a lazy
+    generator and dispatching starts right away. Without one, the whole
+    list is collected and sorted first. reserve workers only take jobs
+    from the small end of the whole list, so that small packages keep
+    flowing while the other workers chew on the big ones: with a reserve,
+    the jobs are always sorted, whatever largest_first and lookahead are.
+
+    """
+    processes = processes or default_workers()
+    reserve = min(max(reserve, 0), processes - 1)
+    stats = Makespan(processes)
+    # jobs are numbered in their original (walk) order for the report
+    jobs = ((seq, size, args) for seq, (size, args) in enumerate(jobs))
+    if largest_first and lookahead and not reserve:
+        jobs = _largest_first(jobs, lookahead)
+    elif largest_first or reserve:
+        jobs = sorted(jobs, key=lambda job: job[1], reverse=True)
+
+    if reserve:
+        pools = [pool(processes - reserve, window), pool(reserve, None)]
+    else:
+        pools = [pool(processes, window)]
+    controller = None
+    if adaptive is not None:
+        controller = Controller(pools[0], adaptive)
+        controller.start()
+
+    start = time.time()
+    if reserve:
+        queue = deque(jobs)
+        feeders = [threading.Thread(target=_feed,
+                                    args=(each, take, func, callback, stats,
+                                          number))
+                   for each, take in zip(pools, (queue.popleft, queue.pop))]
+        for feeder in feeders:
+            feeder.start()
+        for feeder in feeders:
+            feeder.join()
+    else:
+        _feed(pools[0], partial(next, iter(jobs)), func, callback, stats,
+              number)
+
+    for each in pools:
+        each.close()
+    for each in pools:
+        each.join()
+    if controller is not None:
+        controller.stop()
+    stats.elapsed = time.time() - start
+    return stats
+
+
+def _largest_first(jobs, lookahead):
+    """Generate jobs ((seq, size, args), ...) largest first among the next
+    lookahead of them"""
+    heap = []
+    for seq, size, args in jobs:
+        heapq.heappush(heap, (-size, seq, args))
+        if len(heap) >= lookahead:
+            size, seq, args = heapq.heappop(heap)
+            yield seq, -size, args
+    while heap:
+        size, seq, args = heapq.heappop(heap)
+        yield seq, -size, args
+
+
+def _feed(pool, take, func, callback, stats, number=None):
+    """Submit the jobs returned by take() to pool until none are left"""
+    while True:
+        try:
+            seq, _, args = take()
+        except (IndexError, StopIteration):
+            return
+        if number is not None:
+            args = (number(),) + tuple(args)
+        stats.dispatched(seq)
+        pool.submit(func, args, callback,
+                    timer=lambda elapsed, seq=seq: stats.record(seq, elapsed))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Concatenate and verify the outputs of a scan split across several nodes
+with --shard i/N (scanner.py, deb-scanner.py).
+
+Every package (build) has to show up in exactly one output. Only the
+first record of a build is written, later duplicates are dropped (and
+reported). Without --repo, that is the only check. With --repo, the
+shard of every package in the repository is computed the way the nodes
+did it, and the outputs are checked for
+
+- packages from more than one shard in a single output (a node started
+  with the wrong --shard)
+- shards which no output covers
+- packages missing from the output of their shard (JSON outputs only, CSV
+  outputs have no lines for packages without ELF files)
+
+Problems are reported on the standard error, and make the exit status 1.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import gzip
+import json
+import argparse
+from collections import defaultdict
+
+from scheduler import walk
+from sharding import shard_of, source, scanned
+
+
+def records(filename):
+    """
+    Generate (build, lines) for the records of a scan output, NDJSON,
+    indented JSON or CSV, compressed if filename ends with .gz.
+
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f:
+        pending = []
+        for line in f:
+            text = line.decode("utf-8", "replace")
+            if not pending and not text.strip():
+                continue
+            if not pending and not text.startswith("{"):
+                # CSV: package,build,...
+                fields = text.split(",")
+                yield fields[1] if len(fields) > 1 else "", [line]
+                continue
+            pending.append(line)
+            if not text.rstrip().endswith("}"):
+                continue
+            try:
+                record = json.loads(b"".join(pending).decode("utf-8",
+                                                             "replace"))
+            except ValueError:
+                # a nested object of an indented record
+                continue
+            yield record.get("build", ""), pending
+            pending = []
+        if pending:
+            print("[-] %s: truncated record at the end" % filename,
+                  file=sys.stderr)
+
+
+def repository(path, count):
+    """{build: shard} of the packages below path"""
+    return dict((os.path.basename(filename), shard_of(source(filename), count))
+                for filename in walk(path, scanned))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concatenate and verify "
+                                     "the outputs of a sharded scan")
+    parser.add_argument("inputs", nargs="+", metavar="input",
+                        help="output of a node (compressed if it ends with "
+                        ".gz)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="concatenated output file, compressed if it "
+                        "ends with .gz (default: standard output)")
+    parser.add_argument("--repo", metavar="PATH",
+                        help="repository the nodes scanned, to check the "
+                        "outputs against it")
+    parser.add_argument("--shards", type=int, metavar="N",
+                        help="number of shards the scan was split into "
+                        "(required with --repo)")
+    args = parser.parse_args()
+    if args.repo and not args.shards:
+        parser.error("--repo requires --shards")
+
+    problems = []
+    expected = repository(args.repo, args.shards) if args.repo else None
+    # build -> input it was found in
+    found = {}
+    # input -> shards of its builds
+    covered = defaultdict(set)
+    json_inputs = set()
+
+    if args.output == "-":
+        output = getattr(sys.stdout, "buffer", sys.stdout)
+    else:
+        opener = gzip.open if args.output.endswith(".gz") else open
+        output = opener(args.output, "wb")
+    try:
+        for filename in args.inputs:
+            last = None
+            duplicate = False
+            for build, lines in records(filename):
+                if lines[0].lstrip().startswith(b"{"):
+                    json_inputs.add(filename)
+                # the lines of a CSV record are consecutive
+                if build != last or filename in json_inputs:
+                    duplicate = build in found
+                    if duplicate:
+                        problems.append("%s: duplicate of %s in %s, "
+                                        "dropped" %
+                                        (filename, build, found[build]))
+                    else:
+                        found[build] = filename
+                    if expected is not None:
+                        if build in expected:
+                            covered[filename].add(expected[build])
+                        else:
+                            print("[*] %s: %s isn't in the repository" %
+                                  (filename, build), file=sys.stderr)
+                last = build
+                if duplicate:
+                    continue
+                for line in lines:
+                    output.write(line)
+    finally:
+        if output is not getattr(sys.stdout, "buffer", sys.stdout):
+            output.close()
+
+    if expected is not None:
+        owners = defaultdict(list)
+        for filename, shards in sorted(covered.items()):
+            if len(shards) > 1:
+                problems.append("%s: mixes shards %s of %d" %
+                                (filename, ", ".join(map(str,
+                                                         sorted(shards))),
+                                 args.shards))
+            for index in shards:
+                owners[index].append(filename)
+        for index in sorted(set(expected.values())):
+            if not owners[index]:
+                problems.append("shard %d/%d: no output" %
+                                (index, args.shards))
+            elif len(owners[index]) > 1:
+                problems.append("shard %d/%d: in %s" %
+                                (index, args.shards,
+                                 ", ".join(owners[index])))
+        for build, index in sorted(expected.items()):
+            if build not in found and \
+                    any(name in json_inputs for name in owners[index]):
+                problems.append("shard %d/%d: %s is missing" %
+                                (index, args.shards, build))
+
+    for problem in problems:
+        print("[-] %s" % problem, file=sys.stderr)
+    print("[+] %d packages from %d outputs, %d problems" %
+          (len(found), len(args.inputs), len(problems)), file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Deterministic sharding of repository scans across several nodes.
+
+A scan is split into N shards by a stable hash of the source package name
+of every package, so that every node started with --shard i/N keeps the
+same packages no matter how the repository is laid out on disk or in which
+order it is walked, and the binary packages of a source package (and its
+debuginfo) always end up on the same node.
+
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import hashlib
+import argparse
+
+# name-version-release of a source RPM file name
+SRPM_RE = re.compile(r"^(.+)-[^-]+-[^-]+\.(?:no)?src\.rpm$")
+
+
+def shard_argument(value):
+    """argparse type for "i/N", returns (i, N)"""
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, got %r" % value)
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard %r out of range, i must "
+                                         "be between 0 and N - 1" % value)
+    return index, count
+
+
+def shard_of(source, count):
+    """Shard (out of count) of the source package named source"""
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    return int(digest[:16], 16) % count
+
+
+def in_shard(source, shard):
+    """Whether the source package named source belongs to shard (i, N)"""
+    index, count = shard
+    return shard_of(source, count) == index
+
+
+def scanned_rpm(filename):
+    """Whether scanner.py picks filename up when walking a repository"""
+    return filename.endswith(".rpm") and "-debuginfo-" not in filename
+
+
+def scanned(filename):
+    """Whether scanner.py or deb-scanner.py pick filename up when walking a
+    repository"""
+    return filename.endswith(".deb") or scanned_rpm(filename)
+
+
+def srpm_name(srpm, fallback=None):
+    """
+    Name of the source package from its file name (the SOURCERPM tag of a
+    binary package), fallback if it can't be parsed.
+
+    """
+    if isinstance(srpm, bytes):
+        srpm = srpm.decode("utf-8", "replace")
+    found = SRPM_RE.match(srpm or "")
+    return found.group(1) if found else fallback
+
+
+def deb_source(debfile):
+    """
+    Name of the source package of debfile, the Source field of its control
+    file without the version, or the Package field if it has none.
+
+    """
+    from debian.debfile import DebFile
+    control = DebFile(filename=debfile).debcontrol()
+    source = control.get("Source") or control.get("Package")
+    return source.split()[0] if source else None
+
+
+def source(filename, ts=None):
+    """
+    Name of the source package of filename, an RPM package (its header is
+    read with the rpm transaction set ts, a new one by default) or a
+    Debian package. Packages which can't be read go by their file name, so
+    that exactly one node reports them.
+
+    """
+    try:
+        if filename.endswith(".deb"):
+            name = deb_source(filename)
+        else:
+            name = _rpm_source(filename, ts)
+    except Exception:
+        name = None
+    return name or os.path.basename(filename)
+
+
+def _rpm_source(rpmfile, ts=None):
+    import rpm
+    if ts is None:
+        ts = rpm.TransactionSet()
+        ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+    with open(rpmfile, "rb") as f:
+        h = ts.hdrFromFdno(f.fileno())
+    return srpm_name(h[rpm.RPMTAG_SOURCERPM], h[rpm.RPMTAG_NAME])
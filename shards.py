@@ -0,0 +1,210 @@
+"""
+Per-process compressed output shards.
+
+Instead of sending every result back to the parent, which then prints it
+under a lock, each worker appends its records to its own gzip compressed
+shard in an output directory. Every record is numbered by the scanner
+and a worker receives its records in increasing order, so each shard is
+sorted and merge() can restore a single ordered file by merging them.
+
+<dir>/<name>.gz holds the records (NDJSON or CSV lines), <dir>/<name>.idx
+the number and the line count of each one. <dir>/<name>.journal is the
+append-only journal of the builds completed by the shard, it is only
+written (and fsynced, in batches) once their records are on disk. Records
+which aren't journaled are left out by merge(), their builds are redone
+by a resumed scan (see resume()), which writes new shards of its own
+(a new segment, <segment>-<pid>).
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import gzip
+import time
+import heapq
+import argparse
+from multiprocessing.util import Finalize
+
+# the shard of this process
+shard = None
+# segment of the shards written by this scan
+segment = 0
+
+# the journal is synced after this many builds or seconds, whichever
+# comes first
+JOURNAL_INTERVAL = 256
+JOURNAL_SECONDS = 5.0
+
+
+class Shard(object):
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.data = gzip.open(path + ".gz", "ab")
+        self.index = open(path + ".idx", "a")
+        self.journal = open(path + ".journal", "a")
+        self.completed = []
+        self.synced = time.time()
+
+    def write(self, seq, record, build=None):
+        """
+        Append record (one or more lines of text, nothing if it's empty)
+        numbered seq, and journal it, as the record of build if given.
+
+        """
+        if record:
+            self.data.write((record + "\n").encode("utf-8"))
+            self.index.write("%d %d\n" % (seq, record.count("\n") + 1))
+        self.completed.append("%d %s\n" % (seq, build or ""))
+        if len(self.completed) >= JOURNAL_INTERVAL or \
+                time.time() - self.synced >= JOURNAL_SECONDS:
+            self.sync()
+
+    def sync(self):
+        """Get the records to disk, then journal their builds"""
+        self.data.flush()
+        os.fsync(self.data.fileobj.fileno())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.journal.writelines(self.completed)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.completed = []
+        self.synced = time.time()
+
+    def close(self):
+        # shards.close() and the exit of the process both get here
+        if self.data.closed:
+            return
+        self.sync()
+        self.data.close()
+        self.index.close()
+        self.journal.close()
+
+
+def writer(directory, opformat):
+    """
+    The Shard of this process in directory for records in opformat,
+    opened on first use and closed when the process exits.
+
+    """
+    global shard
+    if shard is None or shard.pid != os.getpid():
+        path = os.path.join(directory, "%d-%d.%s" % (segment, os.getpid(),
+                                                     suffix(opformat)))
+        shard = Shard(path)
+        # a pool worker leaves through os._exit(), without this finalizer
+        # the gzip trailer and the last journal batch would be lost
+        Finalize(shard, shard.close, exitpriority=10)
+    return shard
+
+
+def close():
+    """Close the shard of this process, if it has one"""
+    global shard
+    if shard is not None and shard.pid == os.getpid():
+        shard.close()
+    shard = None
+
+
+def suffix(opformat):
+    return "ndjson" if opformat == "json" else opformat
+
+
+def _journal(path):
+    """(seq, build) of the journal of the shard at path"""
+    try:
+        with open(path + ".journal") as journal:
+            for entry in journal:
+                seq, _, build = entry.rstrip("\n").partition(" ")
+                # the last entry may have been cut short
+                if entry.endswith("\n"):
+                    yield int(seq), build
+    except IOError:
+        return
+
+
+def _records(path):
+    """Generate (seq, lines) for the journaled records of the shard at
+    path"""
+    journaled = None
+    if os.path.exists(path + ".journal"):
+        journaled = set(seq for seq, _ in _journal(path))
+    with open(path + ".idx") as index:
+        with gzip.open(path + ".gz", "rb") as data:
+            for entry in index:
+                seq, count = entry.split()
+                try:
+                    lines = [data.readline() for _ in range(int(count))]
+                except (IOError, EOFError) as exc:
+                    print("[-] %s: %s" % (path, exc), file=sys.stderr)
+                    return
+                if not lines[-1].endswith(b"\n"):
+                    # the writer didn't get to finish this one
+                    print("[-] %s: truncated record %s" % (path, seq),
+                          file=sys.stderr)
+                    return
+                if journaled is None or int(seq) in journaled:
+                    yield int(seq), lines
+
+
+def shards(directory):
+    """Paths (without extension) of the shards in directory"""
+    return sorted(os.path.join(directory, name[:-4])
+                  for name in os.listdir(directory)
+                  if name.endswith(".idx"))
+
+
+def resume(directory):
+    """
+    Continue the scan writing its shards to directory: the builds it
+    completed so far are returned, and the records of this scan will
+    be numbered after its last one, in a new segment.
+
+    """
+    global segment
+    done = set()
+    last = -1
+    for path in shards(directory):
+        name = os.path.basename(path)
+        if "-" in name:
+            segment = max(segment, int(name.split("-", 1)[0]) + 1)
+        for seq, build in _journal(path):
+            if build:
+                done.add(build)
+            last = max(last, seq)
+    return done, last + 1
+
+
+def merge(directory, output):
+    """Write the records of all shards in directory to output, in order"""
+    merged = heapq.merge(*[_records(path) for path in shards(directory)])
+    for _, lines in merged:
+        for line in lines:
+            output.write(line)
+
+
+def merge_to(directory, filename):
+    """merge() into filename ("-" for standard output), compressed if it
+    ends with .gz"""
+    if filename == "-":
+        merge(directory, getattr(sys.stdout, "buffer", sys.stdout))
+        return
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "wb") as output:
+        merge(directory, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge output shards")
+    parser.add_argument("directory", help="directory with output shards")
+    parser.add_argument("output", nargs="?", default="-",
+                        help="merged output file, compressed if it ends "
+                        "with .gz (default: standard output)")
+    args = parser.parse_args()
+    merge_to(args.directory, args.output)
+
+if __name__ == "__main__":
+    main()
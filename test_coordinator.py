@@ -0,0 +1,126 @@
+"""Tests for the leases of coordinator.py, with local workers"""
+
+import io
+import os
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from coordinator import Coordinator, Client, serve
+
+
+class Connection(object):
+    """Stands for the Handler of a worker connection"""
+    def __init__(self, name):
+        self.name = name
+
+
+class TestCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, "coordinator.sock")
+        self.log = io.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def serve(self, paths):
+        """Start serving paths, returns the coordinator and the thread
+        serving it"""
+        coordinator = Coordinator(paths, output=self.log)
+        thread = threading.Thread(target=serve,
+                                  args=(coordinator, self.address))
+        thread.daemon = True
+        thread.start()
+        return coordinator, thread
+
+    def connect(self, name):
+        deadline = time.time() + 10
+        while True:
+            try:
+                return Client(self.address, worker=name)
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def test_dying_worker(self):
+        paths = ["p%02d.rpm" % i for i in range(20)]
+        coordinator, thread = self.serve(paths)
+
+        # takes a package and dies before completing it
+        dying = self.connect("dying")
+        taken = dying.request(op="take", count=1)["paths"]
+        self.assertEqual(taken, ["p00.rpm"])
+        dying.close()
+        deadline = time.time() + 10
+        while not coordinator.reassigned and time.time() < deadline:
+            time.sleep(0.01)
+
+        accepted = []
+
+        def work(name):
+            client = self.connect(name)
+            for path in client.paths(count=2):
+                if client.done(path):
+                    accepted.append(path)
+            client.close()
+
+        workers = [threading.Thread(target=work, args=(name,))
+                   for name in ("first", "second")]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        thread.join(30)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(accepted), paths)
+        self.assertEqual(coordinator.reassigned, 1)
+        self.assertEqual(coordinator.finished, set(paths))
+        self.assertIn("dying: reassigning p00.rpm", self.log.getvalue())
+
+    def test_completions(self):
+        coordinator = Coordinator(["a.rpm", "b.rpm"], output=self.log)
+        connection = Connection("worker")
+        self.assertEqual(coordinator.take(connection, 1),
+                         {"paths": ["a.rpm"]})
+        # never served, or not even in the listing
+        self.assertFalse(coordinator.complete(connection,
+                                              "b.rpm")["accepted"])
+        self.assertFalse(coordinator.complete(connection,
+                                              "c.rpm")["accepted"])
+        self.assertTrue(coordinator.complete(connection, "a.rpm")["accepted"])
+        self.assertFalse(coordinator.complete(connection,
+                                              "a.rpm")["accepted"])
+        self.assertEqual(coordinator.rejected, 3)
+        self.assertFalse(coordinator.done())
+
+    def test_expired_lease(self):
+        coordinator = Coordinator(["a.rpm"], lease_timeout=0,
+                                  output=self.log)
+        first, second = Connection("first"), Connection("second")
+        self.assertEqual(coordinator.take(first, 1), {"paths": ["a.rpm"]})
+        time.sleep(0.01)
+        self.assertEqual(coordinator.take(second, 1), {"paths": ["a.rpm"]})
+        self.assertEqual(coordinator.reassigned, 1)
+        # the first completion wins, late or not
+        self.assertTrue(coordinator.complete(first, "a.rpm")["accepted"])
+        self.assertFalse(coordinator.complete(second, "a.rpm")["accepted"])
+        self.assertEqual(coordinator.take(second, 1),
+                         {"paths": [], "done": True})
+
+    def test_empty_listing(self):
+        coordinator, thread = self.serve([])
+        client = self.connect("idle")
+        self.assertEqual(list(client.paths()), [])
+        client.close()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
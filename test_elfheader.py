@@ -0,0 +1,119 @@
+"""Tests for elfheader and checksec.check_image() on hostile ELF files"""
+
+import struct
+import unittest
+from io import BytesIO
+
+from elftools.common.exceptions import ELFError
+
+from checksec import check_image, CHECK_NAMES
+from elfheader import ElfHeader, ElfLimit, MAX_SEGMENTS, SHN_XINDEX, \
+    SHT_SYMTAB, read_elf
+
+EHDR = struct.Struct("<16sHHIQQQIHHHHHH")
+SHDR = struct.Struct("<IIQQQQIIQQ")
+IDENT = b"\x7fELF\x02\x01\x01" + b"\0" * 9
+
+
+def ehdr(phoff=0, shoff=0, phentsize=56, phnum=0, shentsize=SHDR.size,
+         shnum=0, shstrndx=0):
+    """64-bit little endian ELF header of an ET_DYN x86_64 file"""
+    return EHDR.pack(IDENT, 3, 62, 1, 0, phoff, shoff, 0, EHDR.size,
+                     phentsize, phnum, shentsize, shnum, shstrndx)
+
+
+def shdr(name=0, sh_type=0, offset=0, size=0, link=0, info=0, entsize=0):
+    return SHDR.pack(name, sh_type, 0, 0, offset, size, link, info, 0,
+                     entsize)
+
+
+def image(sections, shstrtab, **fields):
+    """
+    ELF file with the section headers in sections (sh_offset of the
+    section name string table patched in) followed by shstrtab.
+
+    """
+    shoff = EHDR.size
+    strtab = shoff + SHDR.size * len(sections)
+    headers = [section(strtab) for section in sections]
+    return ehdr(shoff=shoff, **fields) + b"".join(headers) + shstrtab
+
+
+class TestElfHeader(unittest.TestCase):
+    def test_not_elf(self):
+        self.assertRaises(ELFError, ElfHeader, b"\0" * 64)
+        self.assertRaises(ELFError, ElfHeader, b"\x7fELF")
+
+    def test_truncated_header(self):
+        with self.assertRaises(ElfLimit):
+            ElfHeader(IDENT + b"\0" * 4)
+
+    def test_segments_past_the_end(self):
+        elf = ElfHeader(ehdr(phoff=EHDR.size, phnum=2))
+        with self.assertRaises(ElfLimit):
+            elf.segments
+
+    def test_too_many_segments(self):
+        elf = ElfHeader(ehdr(phoff=EHDR.size, phnum=MAX_SEGMENTS + 1))
+        with self.assertRaises(ElfLimit):
+            elf.segments
+
+    def test_undersized_entsize(self):
+        elf = ElfHeader(ehdr(phoff=EHDR.size, phnum=1, phentsize=8))
+        with self.assertRaises(ElfLimit):
+            elf.segments
+        elf = ElfHeader(ehdr(shoff=EHDR.size, shnum=1, shentsize=8))
+        with self.assertRaises(ElfLimit):
+            elf.sections()
+
+    def test_extended_numbering(self):
+        # e_shnum and e_shstrndx come from sh_size and sh_link of section 0
+        buf = image([lambda strtab: shdr(size=3, link=2),
+                     lambda strtab: shdr(name=1, sh_type=SHT_SYMTAB),
+                     lambda strtab: shdr(name=9, offset=strtab, size=19)],
+                    b"\0.symtab\0.shstrtab\0",
+                    shnum=0, shstrndx=SHN_XINDEX)
+        sections = ElfHeader(buf).sections()
+        self.assertEqual([s.name for s in sections],
+                         ["", ".symtab", ".shstrtab"])
+        self.assertEqual(len(ElfHeader(buf).symbol_tables()), 1)
+
+    def test_symbol_entsize(self):
+        buf = image([lambda strtab: shdr(),
+                     lambda strtab: shdr(sh_type=SHT_SYMTAB, offset=strtab,
+                                         size=64, link=0, entsize=1)],
+                    b"\0" * 64, shnum=2)
+        elf = ElfHeader(buf)
+        section = elf.symbol_tables()[0]
+        with self.assertRaises(ElfLimit):
+            list(elf.symbol_names(section))
+
+
+class TestReadElf(unittest.TestCase):
+    def test_read_elf(self):
+        self.assertEqual(read_elf(BytesIO(IDENT)), IDENT)
+        member = BytesIO(b"#!/bin/sh\n" + b"x" * 4096)
+        self.assertIsNone(read_elf(member))
+        # the rest of the member is left alone
+        self.assertEqual(member.tell(), 4)
+
+
+class TestCheckImage(unittest.TestCase):
+    def test_truncated_header(self):
+        result = check_image(BytesIO(IDENT + b"\0" * 4))
+        for name in CHECK_NAMES:
+            self.assertTrue(getattr(result, name).startswith("Unchecked$"))
+
+    def test_selected_checks(self):
+        result = check_image(BytesIO(IDENT + b"\0" * 4),
+                             checks=["NX", "PIE"])
+        self.assertEqual(result.as_dict(), {
+            "NX": "Unchecked$truncated at offset 0",
+            "PIE": "Unchecked$truncated at offset 0"})
+
+    def test_not_elf(self):
+        self.assertRaises(ELFError, check_image, BytesIO(b"\0" * 64))
+
+
+if __name__ == "__main__":
+    unittest.main()
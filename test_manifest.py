@@ -0,0 +1,57 @@
+"""Tests for the change detection of manifest.Manifest"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from manifest import Manifest, options, is_manifest
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "scan.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_is_manifest(self):
+        # a typo mustn't be taken for a new, empty manifest
+        self.assertFalse(is_manifest(self.path))
+        self.assertFalse(is_manifest(self.directory))
+        results = os.path.join(self.directory, "results.json")
+        with open(results, "w") as f:
+            f.write('{"build": "bash-5.0-1.x86_64.rpm"}\n')
+        self.assertFalse(is_manifest(results))
+        Manifest(self.path, options("json")).close()
+        self.assertTrue(is_manifest(self.path))
+
+    def test_lookup(self):
+        manifest = Manifest(self.path, options("json"))
+        self.assertIsNone(manifest.lookup("a.rpm", 10, 1.0))
+        manifest.store("a.rpm", 10, 1.0, "sha1", "result")
+        self.assertEqual(manifest.lookup("a.rpm", 10, 1.0), "result")
+        # changed, the header is only compared when the file changed
+        self.assertIsNone(manifest.lookup("a.rpm", 11, 1.0))
+        self.assertIsNone(manifest.lookup("a.rpm", 10, 2.0,
+                                          lambda: "other"))
+        # touched or copied: same header, and the new size and mtime are
+        # remembered
+        self.assertEqual(manifest.lookup("a.rpm", 10, 2.0, lambda: "sha1"),
+                         "result")
+        self.assertEqual(manifest.lookup("a.rpm", 10, 2.0), "result")
+        self.assertEqual((manifest.unchanged, manifest.rescanned), (3, 1))
+        manifest.close()
+
+        # results are kept across scans, for the same options only
+        manifest = Manifest(self.path, options("json"))
+        self.assertEqual(manifest.lookup("a.rpm", 10, 2.0), "result")
+        manifest.close()
+        manifest = Manifest(self.path, options("json", ["NX"]))
+        self.assertIsNone(manifest.lookup("a.rpm", 10, 2.0))
+        manifest.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
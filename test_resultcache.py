@@ -0,0 +1,105 @@
+"""Tests for the LRU eviction and the keys of resultcache.ResultCache"""
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import multiprocessing
+
+from elftools.common.exceptions import ELFError
+
+import resultcache
+from checksec import CheckResult
+from resultcache import ResultCache, NOT_ELF
+
+
+def result(nx):
+    out = CheckResult()
+    out.NX = nx
+    return out
+
+
+def hit(cache, key):
+    """Pool worker stand-in, a hit and exit"""
+    cache.get(key)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def atimes(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return dict(db.execute("SELECT key, atime FROM results"))
+        finally:
+            db.close()
+
+    def test_roundtrip(self):
+        cache = ResultCache(self.path)
+        key = cache.key("sha256:00", ["NX"])
+        self.assertIsNone(cache.get(key))
+        cache.put(key, result("Enabled"))
+        self.assertEqual(cache.get(key).as_dict(), {"NX": "Enabled"})
+        cache.put(key, NOT_ELF)
+        self.assertIs(cache.get(key), NOT_ELF)
+        self.assertEqual((cache.hits.value, cache.misses.value), (2, 1))
+
+    def test_not_elf(self):
+        cache = ResultCache(self.path)
+        for _ in range(2):
+            self.assertRaises(ELFError, cache.process, b"\0" * 64)
+        self.assertEqual((cache.hits.value, cache.misses.value), (1, 1))
+
+    def test_keys(self):
+        # the selection of checks and the checker version are part of it
+        self.assertNotEqual(ResultCache.key("sha256:00", ["NX"]),
+                            ResultCache.key("sha256:00", ["NX", "PIE"]))
+        self.assertEqual(ResultCache.key("sha256:00", ["PIE", "NX"]),
+                         ResultCache.key("sha256:00", ["NX", "PIE"]))
+        cache = ResultCache(self.path)
+        cache.put(cache.key("sha256:00"), result("Enabled"))
+        version = resultcache.CHECKER_VERSION
+        resultcache.CHECKER_VERSION = version + 1
+        try:
+            self.assertIsNone(cache.get(cache.key("sha256:00")))
+        finally:
+            resultcache.CHECKER_VERSION = version
+
+    def test_lru(self):
+        cache = ResultCache(self.path)
+        keys = [cache.key("sha256:%02d" % i) for i in range(3)]
+        for key in keys:
+            cache.put(key, result("Enabled"))
+            time.sleep(0.01)
+        # the hit on the oldest entry makes the second one the LRU one
+        cache.get(keys[0])
+        cache.flush()
+        size = sum(len(key) + len(result("Enabled").to_bytes())
+                   for key in keys)
+        cache.max_size = size - 1
+        cache.evict()
+        self.assertEqual(sorted(self.atimes()), sorted([keys[0], keys[2]]))
+
+    def test_worker_hits(self):
+        cache = ResultCache(self.path)
+        key = cache.key("sha256:00")
+        cache.put(key, result("Enabled"))
+        before = self.atimes()[key]
+        time.sleep(0.01)
+        # the hit is batched, it's written when the worker exits
+        worker = multiprocessing.Process(target=hit, args=(cache, key))
+        worker.start()
+        worker.join()
+        self.assertEqual(cache.hits.value, 1)
+        self.assertTrue(self.atimes()[key] > before)
+
+
+if __name__ == "__main__":
+    unittest.main()
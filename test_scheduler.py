@@ -0,0 +1,98 @@
+"""Tests for the dispatch order of scheduler.run_jobs()"""
+
+import threading
+import unittest
+
+from scheduler import run_jobs, makespan, BoundedPool
+
+
+class RecordingPool(object):
+    """Pool running jobs in the submitting thread, recording their sizes"""
+    pools = []
+
+    def __init__(self, processes, window):
+        self.processes = processes
+        self.sizes = []
+        RecordingPool.pools.append(self)
+
+    def submit(self, func, args=(), callback=None, timer=None):
+        ret = func(*args)
+        self.sizes.append(ret)
+        if timer is not None:
+            timer(0.0)
+        if callback is not None:
+            callback(ret)
+        # let the other feeder take a job
+        threading.Event().wait(0.001)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def identity(size):
+    return size
+
+
+SIZES = [5, 1, 9, 3, 7, 2, 8, 4, 6, 10]
+
+
+def jobs():
+    return ((size, (size,)) for size in SIZES)
+
+
+class TestRunJobs(unittest.TestCase):
+    def setUp(self):
+        RecordingPool.pools = []
+
+    def run_jobs(self, **kwargs):
+        stats = run_jobs(identity, jobs(), processes=4, pool=RecordingPool,
+                         **kwargs)
+        return stats, RecordingPool.pools
+
+    def test_walk_order(self):
+        stats, pools = self.run_jobs(largest_first=False)
+        self.assertEqual(pools[0].sizes, SIZES)
+        self.assertEqual(stats.order, list(range(len(SIZES))))
+
+    def test_largest_first(self):
+        _, pools = self.run_jobs()
+        self.assertEqual(pools[0].sizes, sorted(SIZES, reverse=True))
+
+    def test_lookahead(self):
+        _, pools = self.run_jobs(lookahead=3)
+        # the largest of the next 3 jobs goes first
+        self.assertEqual(pools[0].sizes, [9, 5, 7, 3, 8, 4, 6, 10, 2, 1])
+
+    def test_reserve(self):
+        for largest_first in (True, False):
+            RecordingPool.pools = []
+            _, (main, reserve) = self.run_jobs(
+                reserve=1, lookahead=3, largest_first=largest_first)
+            self.assertEqual(reserve.processes, 1)
+            self.assertEqual(main.processes, 3)
+            # the reserve takes the smallest jobs, the others the largest
+            # ones, each in order
+            self.assertEqual(sorted(main.sizes + reserve.sizes),
+                             sorted(SIZES))
+            self.assertEqual(main.sizes, sorted(main.sizes, reverse=True))
+            self.assertEqual(reserve.sizes, sorted(reserve.sizes))
+            self.assertTrue(max(reserve.sizes) < min(main.sizes))
+
+    def test_pool(self):
+        results = []
+        run_jobs(identity, jobs(), processes=2, pool=BoundedPool,
+                 callback=results.append)
+        self.assertEqual(sorted(results), sorted(SIZES))
+
+
+class TestMakespan(unittest.TestCase):
+    def test_makespan(self):
+        self.assertEqual(makespan([4, 3, 3], 2), 6)
+        self.assertEqual(makespan([], 2), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Tests for the --shard i/N partitioning of sharding.py"""
+
+import os
+import shutil
+import argparse
+import tempfile
+import unittest
+
+from sharding import shard_argument, shard_of, in_shard, srpm_name, \
+    source, scanned, scanned_rpm
+
+
+class TestSharding(unittest.TestCase):
+    def test_shard_argument(self):
+        self.assertEqual(shard_argument("2/4"), (2, 4))
+        for value in ("4/4", "-1/4", "0/0", "1", "a/b"):
+            self.assertRaises(argparse.ArgumentTypeError, shard_argument,
+                              value)
+
+    def test_partition(self):
+        names = ["package%d" % i for i in range(1000)]
+        for count in (1, 3, 8):
+            shards = [[name for name in names if in_shard(name, (i, count))]
+                      for i in range(count)]
+            # every source package belongs to exactly one shard
+            self.assertEqual(sorted(sum(shards, [])), sorted(names))
+            for members in shards:
+                self.assertTrue(len(members) > len(names) / count / 2)
+
+    def test_stable(self):
+        # the same on every node and every run, not hash() of the name
+        self.assertEqual(shard_of("bash", 1000), 167)
+        self.assertEqual(shard_of(u"bash", 1000), 167)
+
+    def test_srpm_name(self):
+        self.assertEqual(srpm_name("glibc-2.28-1.fc30.src.rpm"), "glibc")
+        self.assertEqual(srpm_name(b"xz-libs-5.2-3.nosrc.rpm"), "xz-libs")
+        self.assertEqual(srpm_name("garbage", "fallback"), "fallback")
+        self.assertEqual(srpm_name(None, "fallback"), "fallback")
+
+    def test_scanned(self):
+        self.assertTrue(scanned_rpm("a/bash-5.0-1.x86_64.rpm"))
+        self.assertFalse(scanned_rpm("a/bash-debuginfo-5.0-1.x86_64.rpm"))
+        self.assertFalse(scanned_rpm("a/bash-5.0-1.x86_64.drpm"))
+        self.assertFalse(scanned_rpm("a/bash_5.0-1_amd64.deb"))
+        self.assertTrue(scanned("a/bash_5.0-1_amd64.deb"))
+        self.assertFalse(scanned("a/README"))
+
+    def test_unreadable_source(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ("broken-1.0-1.x86_64.rpm", "broken_1.0_amd64.deb"):
+                filename = os.path.join(directory, name)
+                with open(filename, "wb") as f:
+                    f.write(b"not a package")
+                # goes by its file name
+                self.assertEqual(source(filename), name)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
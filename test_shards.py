@@ -0,0 +1,97 @@
+"""Tests for the output shards of shards.py: merge, journal and resume"""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import shards
+
+
+def work(directory, numbers):
+    """Pool worker stand-in, writes the records numbered numbers and
+    exits without closing its shard"""
+    for seq in numbers:
+        shards.writer(directory, "json").write(seq, '{"n": %d}' % seq,
+                                               "build-%d" % seq)
+
+
+def merged(directory):
+    output = io.BytesIO()
+    shards.merge(directory, output)
+    return output.getvalue().decode("utf-8").splitlines()
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shards.shard = None
+        shards.segment = 0
+
+    def tearDown(self):
+        shards.close()
+        shutil.rmtree(self.directory)
+
+    def run_workers(self, *numbers):
+        workers = [multiprocessing.Process(target=work,
+                                           args=(self.directory, each))
+                   for each in numbers]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def test_merge(self):
+        self.run_workers([0, 3, 4, 7], [1, 2, 5, 6])
+        self.assertEqual(len(shards.shards(self.directory)), 2)
+        self.assertEqual(merged(self.directory),
+                         ['{"n": %d}' % seq for seq in range(8)])
+
+    def test_multiline_and_empty_records(self):
+        writer = shards.writer(self.directory, "json")
+        writer.write(0, "{\n}", "a")
+        writer.write(1, "", "b")
+        writer.write(2, "{}", "c")
+        shards.close()
+        self.assertEqual(merged(self.directory), ["{", "}", "{}"])
+
+    def test_unjournaled_records(self):
+        writer = shards.writer(self.directory, "json")
+        writer.write(0, "{}", "a")
+        writer.sync()
+        writer.write(1, "{}", "b")
+        # a worker killed before the journal of its last records is synced
+        writer.data.flush()
+        writer.index.flush()
+        self.assertEqual(merged(self.directory), ["{}"])
+        done, start = shards.resume(self.directory)
+        self.assertEqual((done, start), (set(["a"]), 1))
+
+    def test_truncated_record(self):
+        writer = shards.writer(self.directory, "json")
+        writer.write(0, "{}", "a")
+        writer.sync()
+        # the index line of a record whose data never made it
+        writer.index.write("1 1\n")
+        shards.close()
+        self.assertEqual(merged(self.directory), ["{}"])
+
+    def test_resume(self):
+        self.run_workers([0, 2], [1])
+        done, start = shards.resume(self.directory)
+        self.assertEqual(done, set(["build-0", "build-1", "build-2"]))
+        self.assertEqual((start, shards.segment), (3, 1))
+        # the resumed scan writes a new segment, numbered after the first
+        self.run_workers([3, 4])
+        names = [os.path.basename(path)
+                 for path in shards.shards(self.directory)]
+        self.assertEqual(sorted(name.split("-")[0] for name in names),
+                         ["0", "0", "1"])
+        self.assertEqual(merged(self.directory),
+                         ['{"n": %d}' % seq for seq in range(5)])
+
+
+if __name__ == "__main__":
+    unittest.main()